@@ -13,6 +13,13 @@ class Settings(BaseSettings):
     neo4j_password: str
     neo4j_database: str = "neo4j"  # Default database name
 
+    # Models: a small one for internal draft passes, a larger one for final answers
+    draft_llm_model: str = "gpt-4o-mini"
+    final_llm_model: str = "gpt-3.5-turbo"
+    # Cypher generation: pinned snapshot (JSON-mode capable), or a local Ollama model
+    cypher_model: str = "gpt-3.5-turbo-0125"
+    cypher_ollama_model: str = ""  # e.g. "codellama:7b-instruct"; set to run offline
+
     class Config:
         env_file = ".env"
         case_sensitive = False
@@ -1,5 +1,7 @@
+from itertools import islice
+
 from graph.state import GraphState
-from services.neo4j_service import Neo4jService
+from services.neo4j_service import HIDDEN_PROPERTIES, Neo4jService
 from services.llm_service import LLMService
 from services.neo4j_vector_store_service import Neo4jVectorStoreService  # Neo4j native vector search
 from services.embedding_service import EmbeddingService
@@ -42,10 +44,15 @@ Common Query Patterns Examples
 """
 
 
+def get_schema() -> str:
+    """Live (cached) graph schema, falling back to the static summary"""
+    return neo4j_service.get_schema() or SCHEMA
+
+
 def generate_cypher(state: GraphState) -> GraphState:
     """Generate Cypher query from natural language question"""
     question = state["question"]
-    cypher_query = llm_service.generate_cypher(question, SCHEMA)
+    cypher_query = llm_service.generate_cypher(question, get_schema())
     state["cypher_query"] = cypher_query
     return state
 
@@ -87,9 +94,10 @@ def ensure_vector_index(state: GraphState) -> GraphState:
     try:
         count = neo4j_vector_service.count()
         if count == 0:
+            # Bootstrap with small batch to avoid token limits (only 10 rows are pulled)
             nodes = neo4j_service.fetch_all_nodes()
-            # Bootstrap with small batch to avoid token limits
-            neo4j_vector_service.upsert_nodes(nodes[:10])
+            neo4j_vector_service.upsert_nodes(list(islice(nodes, 10)))
+            nodes.close()
     except Exception as e:
         print(f"⚠️  Vector index setup failed: {e}")
     return state
@@ -199,7 +207,7 @@ def cypher_agent(state: GraphState) -> GraphState:
     else:
         question_with_history = question
     
-    augmented_schema = f"{SCHEMA}\n\nContext:\n{context}"
+    augmented_schema = f"{get_schema()}\n\nContext:\n{context}"
     cypher_query = llm_service.generate_cypher(question_with_history, augmented_schema)
     state["cypher_query"] = cypher_query
     print(f"   ✅ Generated: {cypher_query[:100]}...")
@@ -249,7 +257,7 @@ def synthesizer_agent(state: GraphState) -> GraphState:
                 
                 # CRITICAL: Remove embeddings after extraction
                 if isinstance(r, dict):
-                    r = {k: v for k, v in r.items() if k not in ['embedding', '_text_repr']}
+                    r = {k: v for k, v in r.items() if k not in HIDDEN_PROPERTIES}
                     
                     # Handle different result formats:
                     # 1. Direct properties: {'firstName': 'John', 'lastName': 'Doe'}
@@ -437,7 +445,7 @@ def refine_query(state: GraphState) -> GraphState:
             f"- Relaxing WHERE constraints if needed\n"
             f"- Expanding relationship patterns\n"
         )
-        refined_cypher = llm_service.generate_cypher(refinement_prompt, SCHEMA)
+        refined_cypher = llm_service.generate_cypher(refinement_prompt, get_schema())
         state["cypher_query"] = refined_cypher
         state["neo4j_results"] = []  # Reset to re-execute
         state["error"] = ""  # Clear error
@@ -451,7 +459,7 @@ def refine_query(state: GraphState) -> GraphState:
             f"Question: {question}\n\n"
             f"Suggest a more specific query with additional filters or constraints."
         )
-        refined_cypher = llm_service.generate_cypher(refinement_prompt, SCHEMA)
+        refined_cypher = llm_service.generate_cypher(refinement_prompt, get_schema())
         state["cypher_query"] = refined_cypher
         state["neo4j_results"] = []  # Reset to re-execute
         print(f"   ✅ Refined query to be more specific: {refined_cypher[:100]}...")
@@ -494,7 +502,7 @@ def planner_decide(state: GraphState) -> GraphState:
                     clean_results = []
                     for r in limited_results:
                         if isinstance(r, dict):
-                            r_clean = {k: v for k, v in r.items() if k not in ['embedding', '_text_repr']}
+                            r_clean = {k: v for k, v in r.items() if k not in HIDDEN_PROPERTIES}
                             clean_results.append(r_clean)
                     answer = llm_service.interpret_results(question, clean_results)
                     state["final_answer"] = answer if answer else f"I found {len(results)} matching records."
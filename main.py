@@ -5,7 +5,7 @@ from typing import Optional, Dict, Any
 
 from graph.workflow import graph  # Use LangGraph workflow
 from services.conversation_service import conversation_service
-from services.neo4j_service import Neo4jService
+from services.neo4j_service import HIDDEN_PROPERTIES, AsyncNeo4jService, Neo4jService
 from services.csv_import_service import CSVImportService
 
 
@@ -13,7 +13,7 @@ def _remove_embeddings(obj):
     """Recursively remove embedding fields from any nested structure"""
     if isinstance(obj, dict):
         return {k: _remove_embeddings(v) for k, v in obj.items() 
-                if k not in ['embedding', '_text_repr']}
+                if k not in HIDDEN_PROPERTIES}
     elif isinstance(obj, list):
         return [_remove_embeddings(item) for item in obj]
     else:
@@ -196,11 +196,11 @@ async def ask_question(q: Question, response: Response):
         clean_nodes_used = []
         for node in nodes_used:
             node_id = str(node.get("id", ""))
-            clean_node = {k: v for k, v in node.items() if k not in ['embedding', '_text_repr']}
+            clean_node = {k: v for k, v in node.items() if k not in HIDDEN_PROPERTIES}
             # Also clean properties dict if it exists
             if 'properties' in clean_node and isinstance(clean_node['properties'], dict):
                 clean_node['properties'] = {k: v for k, v in clean_node['properties'].items() 
-                                           if k not in ['embedding', '_text_repr']}
+                                           if k not in HIDDEN_PROPERTIES}
             clean_nodes_used.append(clean_node)
             
             nodes_dict[node_id] = {
@@ -354,10 +354,10 @@ async def explore_nodes(
         # Format nodes for UI (remove embeddings, add display names)
         formatted_nodes = []
         for node in results:
-            clean_node = {k: v for k, v in node.items() if k not in ['embedding', '_text_repr']}
+            clean_node = {k: v for k, v in node.items() if k not in HIDDEN_PROPERTIES}
             if 'properties' in clean_node and isinstance(clean_node['properties'], dict):
                 clean_node['properties'] = {k: v for k, v in clean_node['properties'].items() 
-                                          if k not in ['embedding', '_text_repr']}
+                                          if k not in HIDDEN_PROPERTIES}
             # Add display name
             if isinstance(clean_node.get('properties'), dict):
                 props = clean_node['properties']
@@ -495,10 +495,10 @@ async def explore_node(node_id: int, depth: int = 1):
         # Format nodes for UI (remove embeddings, add display names)
         formatted_nodes = []
         for node in subgraph.get("nodes", []):
-            clean_node = {k: v for k, v in node.items() if k not in ['embedding', '_text_repr']}
+            clean_node = {k: v for k, v in node.items() if k not in HIDDEN_PROPERTIES}
             if 'properties' in clean_node and isinstance(clean_node['properties'], dict):
                 clean_node['properties'] = {k: v for k, v in clean_node['properties'].items() 
-                                          if k not in ['embedding', '_text_repr']}
+                                          if k not in HIDDEN_PROPERTIES}
                 # Add display name
                 props = clean_node['properties']
                 if 'firstName' in props and 'lastName' in props:
@@ -673,7 +673,7 @@ async def explore_relationships(
                 "source_label": rel.get("start_label"),
                 "target_label": rel.get("end_label"),
                 "properties": {k: v for k, v in (rel.get("properties") or {}).items() 
-                             if k not in ['embedding', '_text_repr']}
+                             if k not in HIDDEN_PROPERTIES}
             })
         
         return {
@@ -788,7 +788,7 @@ async def explore_relationships(
 @app.get("/statistics")  # Alias for frontend compatibility
 async def get_stats():
     """Get database statistics for UI dashboard"""
-    neo4j_service = Neo4jService()
+    neo4j_service = AsyncNeo4jService()
     try:
         # Get node counts per type
         node_counts_query = """
@@ -796,7 +796,6 @@ async def get_stats():
         RETURN labels(n)[0] as label, count(n) as count
         ORDER BY count DESC
         """
-        node_counts = neo4j_service.execute_query(node_counts_query)
         
         # Get relationship counts per type
         rel_counts_query = """
@@ -804,13 +803,15 @@ async def get_stats():
         RETURN type(r) as type, count(r) as count
         ORDER BY count DESC
         """
-        rel_counts = neo4j_service.execute_query(rel_counts_query)
         
         # Get total counts
         total_nodes_query = "MATCH (n) RETURN count(n) as total"
         total_rels_query = "MATCH ()-[r]->() RETURN count(r) as total"
-        total_nodes_result = neo4j_service.execute_query(total_nodes_query)
-        total_rels_result = neo4j_service.execute_query(total_rels_query)
+
+        # The four queries are independent, so run them concurrently
+        node_counts, rel_counts, total_nodes_result, total_rels_result = await neo4j_service.execute_many(
+            [node_counts_query, rel_counts_query, total_nodes_query, total_rels_query]
+        )
         
         total_nodes = total_nodes_result[0].get("total", 0) if total_nodes_result else 0
         total_rels = total_rels_result[0].get("total", 0) if total_rels_result else 0
@@ -824,7 +825,7 @@ async def get_stats():
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     finally:
-        neo4j_service.close()
+        await neo4j_service.close()
 
 
 @app.get("/schema")
@@ -840,6 +841,26 @@ async def get_schema():
     }
 
 
+@app.post("/refresh-schema")
+async def refresh_schema():
+    """Re-introspect the graph schema after DDL or import changes"""
+    from graph.nodes import llm_service
+    neo4j_service = Neo4jService()
+    try:
+        schema = neo4j_service.get_schema(refresh=True)
+        # Cypher memoized against the old schema is no longer trustworthy
+        llm_service.clear_cache()
+        return {
+            "success": True,
+            "schema_hash": Neo4jService._schema_hash,
+            "schema": schema
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        neo4j_service.close()
+
+
 @app.post("/import/csv")
 async def import_csv(
     file: UploadFile = File(...),
@@ -1,10 +1,89 @@
 """Service for importing additional CSV data into Neo4j"""
 import csv
+import hashlib
 import io
-from typing import List, Dict, Any
+import queue
+import threading
+from functools import lru_cache
+from typing import List, Dict, Any, Optional, Tuple
 from services.neo4j_service import Neo4jService
 
 
+# Labels can't be query parameters, so these are formatted once per node type and
+# reused; only $rows changes between batches, keeping Neo4j's plan cache warm.
+MERGE_BY_ID_QUERY = """
+UNWIND $rows AS row
+MERGE (n:{label} {{id: row.id}})
+ON CREATE SET n += row
+ON MATCH SET n += row
+"""
+
+# Rows without an id MERGE on a hash of their content, so re-importing a file is idempotent
+MERGE_BY_CONTENT_QUERY = """
+UNWIND $rows AS row
+MERGE (n:{label} {{_row_hash: row._row_hash}})
+ON CREATE SET n += row
+"""
+
+CREATE_QUERY = """
+UNWIND $rows AS row
+CREATE (n:{label})
+SET n = row
+"""
+
+
+# Very large uploads are handed to the server in a few big chunks; apoc.periodic.iterate
+# then commits them in parallel server-side batches instead of one driver round-trip per 100 rows.
+LARGE_IMPORT_THRESHOLD = 50 * 1024 * 1024
+LARGE_IMPORT_CHUNK_SIZE = 100_000
+
+PERIODIC_QUERY = """
+CALL apoc.periodic.iterate(
+  'UNWIND $rows AS row RETURN row',
+  '{action}',
+  {{batchSize: 10000, parallel: true, params: {{rows: $rows}}}}
+)
+YIELD committedOperations, errorMessages
+RETURN committedOperations, errorMessages
+"""
+
+
+def _label(node_type: str) -> str:
+    return "`" + node_type.replace("`", "``") + "`"
+
+
+@lru_cache(maxsize=64)
+def _batch_queries(node_type: str, allow_create: bool) -> Tuple[str, str]:
+    """Return the (keyed, unkeyed) batch queries for a node type"""
+    label = _label(node_type)
+    unkeyed = CREATE_QUERY if allow_create else MERGE_BY_CONTENT_QUERY
+    return MERGE_BY_ID_QUERY.format(label=label), unkeyed.format(label=label)
+
+
+@lru_cache(maxsize=64)
+def _periodic_queries(node_type: str, allow_create: bool) -> Tuple[str, str]:
+    """Return the (keyed, unkeyed) apoc.periodic.iterate queries for a node type"""
+    label = _label(node_type)
+    merge = f"MERGE (n:{label} {{id: row.id}}) SET n += row"
+    if allow_create:
+        unkeyed = f"CREATE (n:{label}) SET n = row"
+    else:
+        unkeyed = f"MERGE (n:{label} {{_row_hash: row._row_hash}}) ON CREATE SET n += row"
+    return PERIODIC_QUERY.format(action=merge), PERIODIC_QUERY.format(action=unkeyed)
+
+
+def _split_rows(rows: List[Dict[str, Any]], allow_create: bool) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """Split rows into (keyed, unkeyed); unkeyed rows get a content hash unless plain CREATE is wanted"""
+    keyed = [r for r in rows if r.get("id")]
+    unkeyed = [r for r in rows if not r.get("id")]
+    if not allow_create:
+        unkeyed = [
+            {**r, "_row_hash": hashlib.blake2b(repr(sorted(r.items())).encode(), digest_size=16).hexdigest()}
+            for r in unkeyed
+        ]
+    return keyed, unkeyed
+
+
 class CSVImportService:
     """Handles CSV import and schema extension"""
     
@@ -12,7 +91,7 @@ class CSVImportService:
         self.neo4j_service = Neo4jService()
     
     def import_csv(self, csv_content: str, node_type: str, properties: List[str], 
-                   create_relationships: bool = False) -> Dict[str, Any]:
+                   create_relationships: bool = False, allow_create: bool = False) -> Dict[str, Any]:
         """
         Import CSV data into Neo4j
         
@@ -21,6 +100,8 @@ class CSVImportService:
             node_type: Type of node to create (e.g., "Medication", "Allergy")
             properties: List of property names from CSV header
             create_relationships: Whether to create relationships with existing nodes
+            allow_create: CREATE rows without an id instead of MERGEing on their content
+                (faster, but re-importing the same file duplicates them)
         """
         reader = csv.DictReader(io.StringIO(csv_content))
         nodes_created = 0
@@ -31,41 +112,35 @@ class CSVImportService:
         try:
             index_query = f"CREATE INDEX IF NOT EXISTS FOR (n:{node_type}) ON (n.id)"
             self.neo4j_service.execute_query(index_query)
+            if not allow_create:
+                index_query = f"CREATE INDEX IF NOT EXISTS FOR (n:{node_type}) ON (n._row_hash)"
+                self.neo4j_service.execute_query(index_query)
         except Exception as e:
             errors.append(f"Index creation warning: {str(e)}")
         
-        batch_size = 100
-        batch = []
+        large = len(csv_content) > LARGE_IMPORT_THRESHOLD
+        batch_size = LARGE_IMPORT_CHUNK_SIZE if large else 100
+        # Parse on a background thread while this one writes to Neo4j, so CSV parsing
+        # overlaps with network/commit time. None marks the end of the input.
+        batches: "queue.Queue[Optional[List[Dict[str, Any]]]]" = queue.Queue(maxsize=4)
+        producer = threading.Thread(
+            target=self._produce_batches,
+            args=(reader, properties, batch_size, batches, errors),
+            daemon=True,
+        )
+        producer.start()
         
-        for row in reader:
+        while True:
+            batch = batches.get()
+            if batch is None:
+                break
             try:
-                # Clean properties
-                node_properties = {k: v for k, v in row.items() if k in properties and v}
-                
-                # Create node with all properties
-                props_str = ", ".join([f"`{k}`: ${k}" for k in node_properties.keys()])
-                create_query = f"""
-                MERGE (n:{node_type} {{{props_str}}})
-                RETURN id(n) as node_id
-                """
-                
-                batch.append({
-                    "query": create_query,
-                    "params": node_properties
-                })
-                
-                if len(batch) >= batch_size:
-                    self._execute_batch(batch)
-                    nodes_created += len(batch)
-                    batch = []
-                    
+                written, batch_errors = self._write_batch(node_type, batch, large, allow_create)
+                nodes_created += written
+                errors.extend(batch_errors)
             except Exception as e:
-                errors.append(f"Error processing row: {str(e)}")
-        
-        # Execute remaining batch
-        if batch:
-            self._execute_batch(batch)
-            nodes_created += len(batch)
+                errors.append(f"Error processing batch: {str(e)}")
+        producer.join()
         
         return {
             "nodes_created": nodes_created,
@@ -74,14 +149,70 @@ class CSVImportService:
             "node_type": node_type
         }
     
-    def _execute_batch(self, batch: List[Dict]):
-        """Execute a batch of queries"""
-        with self.neo4j_service.driver.session() as session:
-            for item in batch:
-                try:
-                    session.run(item["query"], item.get("params", {}))
-                except Exception:
-                    pass  # Continue on individual errors
+    @staticmethod
+    def _produce_batches(reader: csv.DictReader, properties: List[str], batch_size: int,
+                         batches: "queue.Queue[Optional[List[Dict[str, Any]]]]", errors: List[str]):
+        """Parse CSV rows into batches and queue them for the writer"""
+        batch = []
+        try:
+            # Validate inline; Neo4j failures are handled per batch by the writer
+            for row in reader:
+                # Clean properties
+                node_properties = {k: v for k, v in row.items() if k in properties and v}
+                if not node_properties:
+                    errors.append(f"Skipped row at line {reader.line_num}: no values for the requested properties")
+                    continue
+                batch.append(node_properties)
+                
+                if len(batch) >= batch_size:
+                    batches.put(batch)
+                    batch = []
+            if batch:
+                batches.put(batch)
+        except csv.Error as e:
+            errors.append(f"Error parsing CSV: {str(e)}")
+        finally:
+            batches.put(None)
+    
+    def _write_batch(self, node_type: str, rows: List[Dict[str, Any]], large: bool,
+                     allow_create: bool = False) -> Tuple[int, List[str]]:
+        """Write rows and return (rows written, error messages)"""
+        if large:
+            return self._execute_periodic_batch(node_type, rows, allow_create)
+        self._execute_batch(node_type, rows, allow_create)
+        return len(rows), []
+    
+    def _execute_batch(self, node_type: str, rows: List[Dict[str, Any]], allow_create: bool = False):
+        """Upsert a batch of rows with one UNWIND query per shape.
+        
+        Rows with an id MERGE on the indexed id only; rows without one MERGE on a
+        content hash, or are created when allow_create is set.
+        """
+        keyed_query, unkeyed_query = _batch_queries(node_type, allow_create)
+        keyed, unkeyed = _split_rows(rows, allow_create)
+        with self.neo4j_service.driver.session(database=self.neo4j_service.database) as session:
+            if keyed:
+                session.run(keyed_query, {"rows": keyed}).consume()
+            if unkeyed:
+                session.run(unkeyed_query, {"rows": unkeyed}).consume()
+        # Written through the driver directly, so drop stale cached reads
+        Neo4jService.clear_result_cache()
+    
+    def _execute_periodic_batch(self, node_type: str, rows: List[Dict[str, Any]],
+                                allow_create: bool = False) -> Tuple[int, List[str]]:
+        """Ship a large chunk in one RPC and let apoc.periodic.iterate batch it server-side"""
+        keyed_query, unkeyed_query = _periodic_queries(node_type, allow_create)
+        keyed, unkeyed = _split_rows(rows, allow_create)
+        written = 0
+        errors = []
+        for query, subset in ((keyed_query, keyed), (unkeyed_query, unkeyed)):
+            if not subset:
+                continue
+            result = self.neo4j_service.execute_query(query, {"rows": subset})
+            if result:
+                written += result[0].get("committedOperations", 0)
+                errors.extend(f"Batch error: {msg}" for msg in (result[0].get("errorMessages") or {}))
+        return written, errors
     
     def create_relationship(self, from_node_type: str, from_property: str, from_value: str,
                            to_node_type: str, to_property: str, to_value: str,
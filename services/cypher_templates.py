@@ -0,0 +1,168 @@
+import re
+import threading
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+
+# Words that narrow a question beyond what a template answers (age, place, gender, dates,
+# negation including "don't"/"dont" and "no longer", ...)
+_QUALIFIER = re.compile(
+    r"\b(?:with|who|whose|having|have|has|had|diagnosed|over|under|above|below|older|younger|"
+    r"age|aged|old|year|years|between|from|in|at|near|living|live|lives|city|state|born|"
+    r"died|dead|deceased|alive|male|female|men|women|man|woman|gender|sex|before|after|since|"
+    r"during|among|per|by|each|not|no|without|never|none|nor|cannot|longer|anymore|except|"
+    r"excluding|other|(?:do|does|did|is|are|was|were|have|has|had|ca|wo)nt)\b|\w+n['’]t\b|\d",
+    re.IGNORECASE,
+)
+_CONDITION = re.compile(
+    r"\b(?:have|has|having|with|diagnosed with|suffering from)\s+(?:a\s+|an\s+)?([a-z][a-z0-9 '\-]{1,60}?)\s*\??\s*$",
+    re.IGNORECASE,
+)
+_LIMIT = re.compile(r"\b(?:top|first)\s+(\d{1,3})\b", re.IGNORECASE)
+
+
+def _no_slots(question: str) -> Optional[Dict[str, str]]:
+    return None if _QUALIFIER.search(question) else {}
+
+
+def _condition_slot(question: str) -> Optional[Dict[str, str]]:
+    match = _CONDITION.search(question)
+    if not match:
+        return None
+    # e.g. "patients over 65 have diabetes": the template would drop the age filter, and
+    # "patients who don't have diabetes" / "no longer have diabetes" would invert the answer
+    if _QUALIFIER.search(question[:match.start()]):
+        return None
+    condition = match.group(1).strip().lower()
+    # Anything that still reads like a compound filter goes to the LLM
+    if re.search(r"\b(?:and|or|but)\b", condition) or _QUALIFIER.search(condition):
+        return None
+    return {"condition": condition.replace("\\", "").replace("'", "\\'")}
+
+
+def _limit_slot(question: str) -> Optional[Dict[str, str]]:
+    match = _LIMIT.search(question)
+    rest = _LIMIT.sub("", question)
+    if _QUALIFIER.search(rest):
+        return None
+    return {"limit": match.group(1) if match else "10"}
+
+
+@dataclass(frozen=True)
+class CypherTemplate:
+    cypher: str
+    exemplars: List[str]
+    slots: Callable[[str], Optional[Dict[str, str]]]
+
+
+TEMPLATES: Dict[str, CypherTemplate] = {
+    "count_patients": CypherTemplate(
+        cypher="MATCH (p:Patient) RETURN count(p) AS numberOfPatients",
+        exemplars=[
+            "How many patients are there?",
+            "What is the total number of patients?",
+            "Count all patients",
+        ],
+        slots=_no_slots,
+    ),
+    "count_patients_with_condition": CypherTemplate(
+        cypher=(
+            "MATCH (p:Patient)-[:HAS_CONDITION]->(c:Condition) "
+            "WHERE toLower(c.description) CONTAINS '{condition}' "
+            "RETURN count(DISTINCT p) AS numberOfPatients"
+        ),
+        exemplars=[
+            "How many patients have diabetes?",
+            "How many patients are diagnosed with hypertension?",
+            "Number of patients with asthma",
+        ],
+        slots=_condition_slot,
+    ),
+    "patients_with_condition": CypherTemplate(
+        cypher=(
+            "MATCH (p:Patient)-[:HAS_CONDITION]->(c:Condition) "
+            "WHERE toLower(c.description) CONTAINS '{condition}' "
+            "RETURN DISTINCT p.id AS id, p.firstName AS firstName, p.lastName AS lastName"
+        ),
+        exemplars=[
+            "Which patients have diabetes?",
+            "List patients with hypertension",
+            "Show me patients diagnosed with asthma",
+        ],
+        slots=_condition_slot,
+    ),
+    "avg_encounter_cost": CypherTemplate(
+        cypher="MATCH (e:Encounter) RETURN avg(e.totalCost) AS averageTotalCost",
+        exemplars=[
+            "What is the average encounter cost?",
+            "Average cost of an encounter",
+            "What do encounters cost on average?",
+        ],
+        slots=_no_slots,
+    ),
+    "most_common_conditions": CypherTemplate(
+        cypher=(
+            "MATCH (p:Patient)-[:HAS_CONDITION]->(c:Condition) "
+            "RETURN c.description AS condition, count(DISTINCT p) AS patientCount "
+            "ORDER BY patientCount DESC LIMIT {limit}"
+        ),
+        exemplars=[
+            "What are the most common conditions?",
+            "Top 5 conditions",
+            "Which conditions are most frequent?",
+        ],
+        slots=_limit_slot,
+    ),
+}
+
+
+class CypherTemplateRouter:
+    """Answer common question shapes from hand-written templates without an LLM call.
+
+    The question is matched to intent exemplars by cosine similarity; a template is
+    used only above ``threshold``, at least ``margin`` ahead of the runner-up intent,
+    and when its slot extractor succeeds.
+    """
+
+    def __init__(self, encode: Callable[[List[str]], np.ndarray], threshold: float = 0.8,
+                 margin: float = 0.05):
+        self.encode = encode
+        self.threshold = threshold
+        self.margin = margin
+        self._intents: List[str] = []
+        self._exemplars: Optional[np.ndarray] = None
+        self._lock = threading.Lock()
+
+    def _exemplar_matrix(self) -> np.ndarray:
+        with self._lock:
+            if self._exemplars is None:
+                texts = []
+                for intent, template in TEMPLATES.items():
+                    self._intents.extend([intent] * len(template.exemplars))
+                    texts.extend(template.exemplars)
+                self._exemplars = np.asarray(self.encode(texts), dtype=np.float32)
+            return self._exemplars
+
+    def route(self, question: str, vec: Optional[np.ndarray] = None) -> Optional[str]:
+        """Filled template for the question, or None to fall back to the LLM"""
+        if vec is None:
+            vec = np.asarray(self.encode([question])[0], dtype=np.float32)
+        sims = self._exemplar_matrix() @ vec
+        # Best exemplar score per intent
+        scores: Dict[str, float] = {}
+        for intent, sim in zip(self._intents, sims.tolist()):
+            scores[intent] = max(sim, scores.get(intent, -1.0))
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        intent, best = ranked[0]
+        if best <= self.threshold:
+            return None
+        # A near-tie between intents is ambiguous; let the LLM decide
+        if len(ranked) > 1 and best - ranked[1][1] < self.margin:
+            return None
+        template = TEMPLATES[intent]
+        slots = template.slots(question)
+        if slots is None:
+            return None
+        return template.cypher.format(**slots)
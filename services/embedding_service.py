@@ -1,31 +1,113 @@
-from typing import List
+import hashlib
+import os
+import sqlite3
+import threading
+from array import array
+from typing import Dict, List, Tuple
 
+import numpy as np
 import openai
 from openai import OpenAI
 
 from config import get_settings
 
 
+class EmbeddingCache:
+    """Persistent content-addressed embedding cache backed by SQLite.
+
+    Vectors are stored as packed float32 bytes, keyed by sha256(model + "\\x00" + text).
+    """
+
+    def __init__(self, cache_dir: str = "./.embed_cache"):
+        os.makedirs(cache_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            os.path.join(cache_dir, "embeddings.sqlite3"),
+            check_same_thread=False,
+        )
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)"
+            )
+
+    @staticmethod
+    def key(model: str, text: str) -> str:
+        return hashlib.sha256(f"{model}\x00{text}".encode("utf-8")).hexdigest()
+
+    def get_many(self, keys: List[str]) -> Dict[str, List[float]]:
+        found: Dict[str, List[float]] = {}
+        unique = list(dict.fromkeys(keys))
+        # Stay well below SQLite's bound-parameter limit
+        for i in range(0, len(unique), 500):
+            chunk = unique[i:i + 500]
+            placeholders = ",".join("?" * len(chunk))
+            with self._lock:
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", chunk
+                ).fetchall()
+            for key, blob in rows:
+                found[key] = array("f", blob).tolist()
+        return found
+
+    def set_many(self, items: Dict[str, List[float]]) -> None:
+        rows = [(key, array("f", vector).tobytes()) for key, vector in items.items()]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)", rows
+            )
+
+
 class EmbeddingService:
-    def __init__(self, model: str = "text-embedding-3-small"):
+    def __init__(self, model: str = "text-embedding-3-small", cache_dir: str = "./.embed_cache"):
         settings = get_settings()
         self.client = OpenAI(api_key=settings.openai_api_key)
         self.model = model
+        self.cache = EmbeddingCache(cache_dir)
 
     def embed_text(self, text: str) -> List[float]:
+        key = EmbeddingCache.key(self.model, text)
+        cached = self.cache.get_many([key])
+        if key in cached:
+            return cached[key]
         response = self.client.embeddings.create(
             model=self.model,
             input=text,
         )
-        return response.data[0].embedding
+        embedding = response.data[0].embedding
+        self.cache.set_many({key: embedding})
+        return embedding
 
     def embed_texts(self, texts: List[str]) -> List[List[float]]:
+        keys, embeddings, missing = self._lookup_cached(texts)
+        if missing:
+            fresh, truncated = self._request_embeddings(list(missing.values()))
+            self._store_fresh(embeddings, missing, fresh, truncated)
+        return [embeddings[key] for key in keys]
+
+    def _lookup_cached(self, texts: List[str]) -> Tuple[List[str], Dict[str, List[float]], Dict[str, str]]:
+        keys = [EmbeddingCache.key(self.model, t) for t in texts]
+        embeddings = self.cache.get_many(keys)
+        missing: Dict[str, str] = {}
+        for key, text in zip(keys, texts):
+            if key not in embeddings:
+                missing[key] = text
+        return keys, embeddings, missing
+
+    def _store_fresh(self, embeddings: Dict[str, List[float]], missing: Dict[str, str],
+                     fresh: List[List[float]], truncated: bool) -> None:
+        fresh_by_key = dict(zip(missing.keys(), fresh))
+        # Don't persist vectors computed from truncated input
+        if not truncated:
+            self.cache.set_many(fresh_by_key)
+        embeddings.update(fresh_by_key)
+
+    def _request_embeddings(self, texts: List[str]) -> Tuple[List[List[float]], bool]:
         try:
             response = self.client.embeddings.create(
                 model=self.model,
                 input=texts,
             )
-            return [item.embedding for item in response.data]
+            return [item.embedding for item in response.data], False
         except openai.BadRequestError as e:
             # Fallback for token limit errors: hard-truncate and retry once
             if hasattr(e, "code") or "max_tokens_per_request" in str(e):
@@ -34,7 +116,13 @@ class EmbeddingService:
                     model=self.model,
                     input=truncated,
                 )
-                return [item.embedding for item in response.data]
+                return [item.embedding for item in response.data], True
             raise
 
 
+def quantize_int8(vector) -> Tuple[float, np.ndarray]:
+    """Quantize a vector to int8 with a per-vector scale; returns (scale, values)"""
+    v = np.asarray(vector, dtype=np.float32)
+    peak = float(np.max(np.abs(v))) if v.size else 0.0
+    scale = peak / 127 if peak > 0 else 1.0
+    return scale, np.round(v / scale).astype(np.int8)
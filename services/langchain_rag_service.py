@@ -1,55 +1,18 @@
 """LangChain Neo4j RAG service (exactly like mentor's notebooks)"""
-from typing import List, Dict, Any, Optional
+import threading
+from functools import lru_cache
+from typing import List, Dict, Any, AsyncIterator, Optional, Tuple
+from cachetools import TTLCache
 from langchain_community.graphs import Neo4jGraph
 from langchain_community.vectorstores import Neo4jVector
 from langchain.chains import RetrievalQAWithSourcesChain, GraphCypherQAChain
 from langchain.prompts.prompt import PromptTemplate
-from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+from langchain_openai import OpenAIEmbeddings
 from config import get_settings
+from services.llm_service import get_chat_model
 
 
-class LangChainRAGService:
-    """LangChain RAG using Neo4jVector and GraphCypherQAChain (exactly like mentor's notebooks)"""
-    
-    def __init__(self):
-        settings = get_settings()
-        
-        # Initialize Neo4j Graph (like notebook)
-        self.kg = Neo4jGraph(
-            url=settings.neo4j_uri,
-            username=settings.neo4j_username,
-            password=settings.neo4j_password,
-            database=getattr(settings, 'neo4j_database', 'neo4j') or 'neo4j'
-        )
-        
-        # Vector store constants (like notebook)
-        self.index_name = 'node_embeddings'
-        self.node_label = 'Node'  # Will match any node type
-        self.text_property = '_text_repr'  # Text representation we store
-        self.embedding_property = 'embedding'
-        
-        # Initialize embeddings
-        self.embeddings = OpenAIEmbeddings(openai_api_key=settings.openai_api_key)
-        
-        # Initialize LLM
-        self.llm = ChatOpenAI(
-            model="gpt-3.5-turbo",
-            api_key=settings.openai_api_key,
-            temperature=0
-        )
-        
-        # Will be initialized when vector index is ready
-        self.vector_store = None
-        self.retriever = None
-        self.qa_chain = None
-        self.cypher_chain = None
-        
-        # Cypher generation template (like Lesson 7)
-        self._setup_cypher_chain()
-    
-    def _setup_cypher_chain(self):
-        """Setup GraphCypherQAChain (like Lesson 7)"""
-        CYPHER_GENERATION_TEMPLATE = """Task:Generate Cypher statement to query a graph database.
+CYPHER_GENERATION_TEMPLATE = """Task:Generate Cypher statement to query a graph database.
 
 Instructions:
 Use only the provided relationship types and properties in the schema.
@@ -82,19 +45,80 @@ ORDER BY frequency DESC
 
 The question is:
 {question}"""
+
+CYPHER_GENERATION_PROMPT = PromptTemplate(
+    input_variables=["schema", "question"], 
+    template=CYPHER_GENERATION_TEMPLATE
+)
+
+# Compiled GraphCypherQAChain per (llm model, Neo4j URI)
+_CYPHER_CHAINS: Dict[Tuple[str, str], GraphCypherQAChain] = {}
+
+
+@lru_cache()
+def _get_graph(url: str, username: str, password: str, database: str) -> Neo4jGraph:
+    """Neo4jGraph introspects the schema on construction, so build it once per process"""
+    return Neo4jGraph(
+        url=url,
+        username=username,
+        password=password,
+        database=database
+    )
+
+
+class LangChainRAGService:
+    """LangChain RAG using Neo4jVector and GraphCypherQAChain (exactly like mentor's notebooks)"""
+    
+    def __init__(self):
+        settings = get_settings()
         
-        CYPHER_GENERATION_PROMPT = PromptTemplate(
-            input_variables=["schema", "question"], 
-            template=CYPHER_GENERATION_TEMPLATE
+        # Initialize Neo4j Graph (like notebook); shared so the schema is fetched once
+        self.neo4j_uri = settings.neo4j_uri
+        self.kg = _get_graph(
+            settings.neo4j_uri,
+            settings.neo4j_username,
+            settings.neo4j_password,
+            getattr(settings, 'neo4j_database', 'neo4j') or 'neo4j'
         )
         
+        # Vector store constants (like notebook)
+        self.index_name = 'node_embeddings'
+        self.node_label = 'Node'  # Will match any node type
+        self.text_property = '_text_repr'  # Text representation we store
+        self.embedding_property = 'embedding'
+        
+        # Initialize embeddings
+        self.embeddings = OpenAIEmbeddings(openai_api_key=settings.openai_api_key)
+        
+        # Initialize LLM
+        self.llm_model = "gpt-3.5-turbo"
+        self.llm = get_chat_model(self.llm_model, settings.openai_api_key)
+        
+        # Will be initialized when vector index is ready
+        self.vector_store = None
+        self.retriever = None
+        self.qa_chain = None
+        self.cypher_chain = None
+        
+        # Recent similarity_search hits keyed by (query, top_k)
+        self._sim_cache = TTLCache(maxsize=512, ttl=300)
+        self._sim_cache_lock = threading.Lock()
+        
+        # Cypher chain using the module-level template (like Lesson 7)
+        self._setup_cypher_chain()
+    
+    def _setup_cypher_chain(self):
+        """Setup GraphCypherQAChain (like Lesson 7), reusing the compiled chain if one exists"""
         try:
-            self.cypher_chain = GraphCypherQAChain.from_llm(
-                self.llm,
-                graph=self.kg,
-                verbose=False,
-                cypher_prompt=CYPHER_GENERATION_PROMPT,
-            )
+            key = (self.llm_model, self.neo4j_uri)
+            if key not in _CYPHER_CHAINS:
+                _CYPHER_CHAINS[key] = GraphCypherQAChain.from_llm(
+                    self.llm,
+                    graph=self.kg,
+                    verbose=False,
+                    cypher_prompt=CYPHER_GENERATION_PROMPT,
+                )
+            self.cypher_chain = _CYPHER_CHAINS[key]
             print("✅ GraphCypherQAChain initialized (like mentor's Lesson 7)")
         except Exception as e:
             print(f"⚠️  Could not initialize GraphCypherQAChain: {e}")
@@ -139,10 +163,7 @@ The question is:
             }
         
         try:
-            response = self.qa_chain(
-                {"question": question},
-                return_only_outputs=True
-            )
+            response = self.qa_chain.invoke({"question": question})
             return {
                 "answer": response.get("answer", ""),
                 "sources": response.get("sources", [])
@@ -162,14 +183,46 @@ The question is:
         
         try:
             # Use GraphCypherQAChain to generate Cypher and execute (like mentor)
-            response = self.cypher_chain.run(question)
-            return response
+            response = self.cypher_chain.invoke({"query": question})
+            return response.get("result", "")
         except Exception as e:
             print(f"⚠️  GraphCypherQAChain failed: {e}")
             # Fallback to vector search
             result = self.answer_with_sources(question)
             return result["answer"]
     
+    async def answer_with_sources_stream(self, question: str) -> AsyncIterator[str]:
+        """Stream answer tokens from the RetrievalQAWithSourcesChain as they are generated"""
+        self.ensure_vector_store()
+        
+        if self.qa_chain is None:
+            yield "Vector store not initialized. Please ensure nodes have embeddings."
+            return
+        
+        # The "stuff" chain makes a single LLM call, so every model token belongs to the answer
+        async for event in self.qa_chain.astream_events({"question": question}, version="v2"):
+            if event["event"] == "on_chat_model_stream":
+                token = event["data"]["chunk"].content
+                if token:
+                    yield token
+    
+    async def answer_with_cypher_stream(self, question: str) -> AsyncIterator[str]:
+        """Stream answer tokens from GraphCypherQAChain (falls back to vector search)"""
+        if self.cypher_chain is None:
+            async for token in self.answer_with_sources_stream(question):
+                yield token
+            return
+        
+        # First model call generates the Cypher; only the second (QA) call is the answer
+        model_calls = 0
+        async for event in self.cypher_chain.astream_events({"query": question}, version="v2"):
+            if event["event"] == "on_chat_model_start":
+                model_calls += 1
+            elif event["event"] == "on_chat_model_stream" and model_calls >= 2:
+                token = event["data"]["chunk"].content
+                if token:
+                    yield token
+    
     def answer(self, question: str) -> str:
         """Answer using GraphCypherQAChain (primary) or RetrievalQAWithSourcesChain (fallback)"""
         # Prefer GraphCypherQAChain (like mentor's Lesson 7)
@@ -187,6 +240,12 @@ The question is:
         if self.retriever is None:
             return []
         
+        key = (query, top_k)
+        with self._sim_cache_lock:
+            cached = self._sim_cache.get(key)
+        if cached is not None:
+            return cached
+        
         try:
             docs = self.retriever.get_relevant_documents(query)
             hits = []
@@ -197,6 +256,8 @@ The question is:
                     "content": doc.page_content[:200],
                     "metadata": doc.metadata
                 })
+            with self._sim_cache_lock:
+                self._sim_cache[key] = hits
             return hits
         except Exception as e:
             print(f"⚠️  Similarity search failed: {e}")
@@ -204,16 +265,20 @@ The question is:
     
     def use_window_retrieval(self, window_size: int = 1):
         """Use window retrieval query (like notebook - expands context around chunks)"""
-        # Custom retrieval query with window (like notebook)
+        # Custom retrieval query with window (like notebook). Neighbours are collected
+        # directly in chain order instead of enumerating every candidate window and
+        # keeping the longest, which is O((k+1)^2) paths per hit.
         retrieval_query_window = f"""
-        MATCH window = (prev:Node)-[:NEXT*0..{window_size}]->(node)-[:NEXT*0..{window_size}]->(next:Node)
-        WHERE node.{self.embedding_property} IS NOT NULL
-        WITH node, score, window as longestWindow 
-        ORDER BY length(window) DESC LIMIT 1
-        WITH nodes(longestWindow) as nodeList, node, score
-        UNWIND nodeList as nodeRow
-        WITH collect(nodeRow.{self.text_property}) as textList, node, score
-        RETURN apoc.text.join(textList, " \\n ") as text,
+        OPTIONAL MATCH before = (prev:Node)-[:NEXT*1..{window_size}]->(node)
+        WITH node, score, prev, length(before) AS distance
+        ORDER BY distance DESC
+        WITH node, score, collect(prev) AS preceding
+        OPTIONAL MATCH after = (node)-[:NEXT*1..{window_size}]->(next:Node)
+        WITH node, score, preceding, next, length(after) AS distance
+        ORDER BY distance ASC
+        WITH node, score, preceding, collect(next) AS following
+        ORDER BY score DESC
+        RETURN apoc.text.join([n IN preceding + [node] + following | n.{self.text_property}], " \\n ") as text,
             score,
             node {{.*}} AS metadata
         """
@@ -235,6 +300,9 @@ The question is:
                 chain_type="stuff",
                 retriever=self.retriever
             )
+            # Cached hits came from the previous retriever
+            with self._sim_cache_lock:
+                self._sim_cache.clear()
             print(f"✅ Window retrieval enabled (window_size={window_size})")
         except Exception as e:
             print(f"⚠️  Window retrieval failed: {e}")
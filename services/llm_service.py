@@ -1,212 +1,150 @@
+import hashlib
+import json
+import queue
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.messages import HumanMessage, SystemMessage
 from langchain_openai import ChatOpenAI
+from pydantic import BaseModel, Field
 from config import get_settings
+from services.cypher_templates import CypherTemplateRouter
 
+# Optional: a small local sentence encoder enables the semantic Cypher cache
+try:
+    from sentence_transformers import SentenceTransformer
+    LOCAL_ENCODER_AVAILABLE = True
+except ImportError:
+    LOCAL_ENCODER_AVAILABLE = False
 
-class LLMService:
-    def __init__(self):
-        settings = get_settings()
-        self.llm = ChatOpenAI(
-            model="gpt-3.5-turbo",
-            api_key=settings.openai_api_key,
-            temperature=0
-        )
+# Optional: self-hosted Cypher generation through Ollama
+try:
+    from langchain_ollama import ChatOllama
+    OLLAMA_AVAILABLE = True
+except ImportError:
+    OLLAMA_AVAILABLE = False
 
-    def generate_cypher(self, question: str, schema: str) -> str:
-        """Generate Cypher query from natural language"""
-        prompt = f"""Convert this question to a Neo4j Cypher query.
-
-Question: {question}
-
-Graph Schema:
-{schema}
-
-    CRITICAL PROPERTY RULES:
-    - Patient has NO 'age' property! Use birthDate and calculate age: duration.between(date(p.birthDate), date()).years
-    - For "over 65": WHERE duration.between(date(p.birthDate), date()).years > 65
-    - For "past year": WHERE e.stop > datetime() - duration({{years: 1}})
-    - Observation category is 'vital-signs' (not 'blood pressure' or 'Blood Pressure')
-
-    IMPORTANT Cypher Syntax Rules:
-    - After WITH with aggregation (e.g., count(), sum()), you CANNOT reference variables from before the WITH clause
-    - Example CORRECT: MATCH (p:Patient)-[:HAS_CONDITION]->(c:Condition) WITH p, count(c) as conditionCount WHERE conditionCount > 1 RETURN p
-    - Example WRONG: MATCH (p:Patient)-[:HAD_ENCOUNTER]->(e:Encounter) WITH p, count(e) as numEncounters WHERE e.baseCost > 100 (CANNOT use 'e' after WITH)
-    - When collecting variables in WITH, include ALL variables you need in RETURN: WITH p, count(c) as conditionCount, collect(c.description) as conditions
-    - For counting patterns: NEVER use size() - ALWAYS use COUNT {{}}: 
-      * WRONG: size((c)<-[:HAS_CONDITION]-())
-      * CORRECT: COUNT {{ (c)<-[:HAS_CONDITION]-(:Patient) }} as patientCount
-      * Example: MATCH (c:Condition) WITH c, COUNT {{ (c)<-[:HAS_CONDITION]-(:Patient) }} as patientCount WHERE patientCount > 50 RETURN c.description, patientCount
-    - RETURN must be at END of query - cannot have RETURN in middle then continue with more clauses
-    - When returning Encounter nodes, always include readable fields: RETURN e.id, e.description, e.start, e.stop OR RETURN e (if you need full node)
-    - For missing/null values: Use IS NULL or IS NOT NULL: WHERE e.stop IS NULL
-    - CRITICAL: When returning patients, ALWAYS use RETURN DISTINCT p (the node), NEVER RETURN DISTINCT p.firstName, p.lastName
-    - To get unique patients: RETURN DISTINCT p (returns unique patient nodes by their node identity)
-    - WRONG: RETURN DISTINCT p.firstName, p.lastName (this only returns unique name combinations, will miss patients with duplicate names - DO NOT USE THIS!)
-    - CORRECT: RETURN DISTINCT p (always use this for patient queries)
-    - IMPORTANT: Patients can have conditions via HAS_CONDITION OR via Encounter-DIAGNOSED. Check both paths if needed:
-      * Example: MATCH (p:Patient)-[:HAS_CONDITION]->(c:Condition) WHERE toLower(c.description) CONTAINS 'diabetes' RETURN DISTINCT p
-      * OR: MATCH (p:Patient)-[:HAD_ENCOUNTER]->(e:Encounter)-[:DIAGNOSED]->(c:Condition) WHERE toLower(c.description) CONTAINS 'diabetes' RETURN DISTINCT p
-    - Example CORRECT: MATCH (p:Patient)-[:HAS_CONDITION]->(c:Condition) WHERE toLower(c.description) CONTAINS 'diabetes' RETURN DISTINCT p
-    - Example WRONG: MATCH (p:Patient)-[:HAS_CONDITION]->(c:Condition) WHERE toLower(c.description) CONTAINS 'diabetes' RETURN DISTINCT p.firstName, p.lastName (DO NOT USE - will return wrong count!)
-
-    MULTIPLE CONDITIONS (AND logic):
-    - For "both X and Y": Use MATCH twice with WHERE on each, then return patients who match both
-    - Example CORRECT: MATCH (p:Patient)-[:HAS_CONDITION]->(c1:Condition) WHERE toLower(c1.description) CONTAINS 'hypertension' WITH p MATCH (p)-[:HAS_CONDITION]->(c2:Condition) WHERE toLower(c2.description) CONTAINS 'obesity' RETURN p
-
-    DATE/TIME CALCULATIONS:
-    - Use duration() for date differences: duration.between(datetime(e.start), datetime(e.stop))
-    - For "within 30 days": Use duration.between(...).days <= 30
-    - For "past year": datetime() - duration({{years: 1}})
-    - For condition duration: Use HAS_CONDITION relationship properties: (p)-[r:HAS_CONDITION]->(c) WHERE r.start and r.stop exist
-    - Example: MATCH (p:Patient)-[r:HAS_CONDITION]->(c:Condition) WHERE r.start IS NOT NULL AND r.stop IS NOT NULL RETURN c.description, AVG(duration.between(datetime(r.start), datetime(r.stop)).days) as avgDuration
-    - CRITICAL: When comparing dates between encounters/procedures, use encounter dates NOT patient birthDate
-    - Example CORRECT (procedure within 30 days of diagnosis): MATCH (p:Patient)-[:HAD_ENCOUNTER]->(e1:Encounter)-[:DIAGNOSED]->(c:Condition), (p)-[:HAD_ENCOUNTER]->(e2:Encounter)-[:HAD_PROCEDURE]->(pr:Procedure) WHERE toLower(c.description) CONTAINS 'diabetes' AND duration.between(datetime(e1.stop), datetime(e2.start)).days <= 30 AND duration.between(datetime(e1.stop), datetime(e2.start)).days >= 0
-    - Example WRONG: duration.between(datetime(e.stop), datetime(p.birthDate)) - NEVER compare encounter dates with birthDate!
-
-    TEXT MATCHING RULES - ALWAYS USE CONTAINS:
-    - NEVER use exact match {{description: "value"}} - ALWAYS use CONTAINS
-    - Example CORRECT: WHERE toLower(c.description) CONTAINS 'diabetes'
-    - Example WRONG: WHERE c.description = "Diabetes" OR {{description: "Diabetes"}}
-    - Use case-insensitive matching: toLower(c.description) CONTAINS 'diabetes'
-    - For blood pressure: WHERE toLower(o.description) CONTAINS 'blood pressure'
-    - For cardiac/heart: Use toLower() with CONTAINS: WHERE toLower(e.reasonDescription) CONTAINS 'cardiac' OR toLower(e.reasonDescription) CONTAINS 'heart'
-    - CRITICAL: When returning patients, ALWAYS use DISTINCT to avoid duplicates: MATCH (p:Patient)-[:HAS_CONDITION]->(c:Condition) WHERE toLower(c.description) CONTAINS 'diabetes' RETURN DISTINCT p.firstName, p.lastName
-    - If a patient has multiple matching conditions, they'll appear multiple times without DISTINCT - ALWAYS use DISTINCT p or DISTINCT p.firstName, p.lastName
-    - Example CORRECT: MATCH (p:Patient)-[:HAS_CONDITION]->(c:Condition) WHERE toLower(c.description) CONTAINS 'diabetes' RETURN DISTINCT p
-    - Example WRONG: MATCH (p:Patient)-[:HAS_CONDITION]->(c:Condition) WHERE toLower(c.description) CONTAINS 'diabetes' RETURN p (missing DISTINCT - will return duplicates!)
-    - IMPORTANT: When using toLower() on properties that might be NULL, check NULL first: WHERE o.category IS NOT NULL AND toLower(o.category) = 'vital-signs'
-    - For Observation category: ALWAYS check NULL first! Use: WHERE (o.category IS NOT NULL AND toLower(o.category) = 'vital-signs') OR toLower(o.description) CONTAINS 'blood pressure'
-    - NEVER use toLower() directly on properties that might be NULL without checking first
-    - Example CORRECT: WHERE (o.category IS NOT NULL AND toLower(o.category) = 'vital-signs') OR toLower(o.description) CONTAINS 'blood pressure'
-    - Example WRONG: WHERE toLower(o.category) = 'vital-signs' AND toLower(o.description) CONTAINS 'blood pressure' (will fail if category is NULL)
-
-    ONLY USE RELATIONSHIPS THAT EXIST:
-    - Available: HAD_ENCOUNTER, HAS_CONDITION, DIAGNOSED, UNDERWENT, HAD_PROCEDURE, HAS_OBSERVATION, RECORDED_OBSERVATION
-    - Do NOT invent relationships like FOLLOWED_BY
-    - For conditions followed by procedures: Use DIAGNOSED on Encounter, then HAD_PROCEDURE on same Encounter
-    - Example: MATCH (e:Encounter)-[:DIAGNOSED]->(c:Condition), (e)-[:HAD_PROCEDURE]->(p:Procedure) WHERE duration.between(datetime(e.start), datetime(e.stop)).days <= 30
-    
-    COMMON QUERY PATTERNS:
-    - Average conditions per patient: MATCH (p:Patient)-[:HAS_CONDITION]->(c:Condition) WITH p, count(c) as conditionCount RETURN avg(conditionCount) as averageConditionsPerPatient
-    - Condition categories: Condition nodes don't have baseCost or totalCost - use Encounter.baseCost/totalCost instead. Example: MATCH (e:Encounter)-[:DIAGNOSED]->(c:Condition) WITH c, MAX(e.baseCost) as maxCost RETURN c.description, maxCost ORDER BY maxCost DESC
-    - Average encounter cost per condition: MATCH (e:Encounter)-[:DIAGNOSED]->(c:Condition) WITH c, AVG(e.totalCost) as avgCost RETURN c.description, avgCost ORDER BY avgCost DESC
-    - Missing dates: WHERE e.stop IS NULL (returns encounters with null stop dates). Always return readable fields: RETURN e.id, e.description, e.start, e.stop
-    - When returning averages/counts, always return the value directly: RETURN avg(conditionCount) as averageConditionsPerPatient (not wrapped in another structure)
-    - Conditions followed by procedures: Use Encounter as bridge - Conditions are DIAGNOSED on Encounters, Procedures are HAD_PROCEDURE on same Encounter
-    - Example: MATCH (e:Encounter)-[:DIAGNOSED]->(c:Condition), (e)-[:HAD_PROCEDURE]->(p:Procedure) WHERE duration.between(datetime(e.start), datetime(e.stop)).days <= 30 RETURN DISTINCT c.description, p.description
-
-Return ONLY the Cypher query, nothing else."""
 
-        response = self.llm.invoke(prompt)
-        query = response.content.strip()
-        
-        # Remove duplicate queries if LLM generated multiple (sometimes happens)
-        lines = query.split('\n')
-        seen_queries = set()
-        unique_lines = []
-        current_query = []
-        
-        for line in lines:
-            line_stripped = line.strip()
-            if not line_stripped:
-                continue
-            # Check if this is a new query start (MATCH, WITH, RETURN at start)
-            if line_stripped.upper().startswith(('MATCH', 'WITH', 'RETURN', 'CALL')):
-                query_key = line_stripped[:50]  # Use first 50 chars as key
-                if query_key not in seen_queries:
-                    seen_queries.add(query_key)
-                    if current_query:
-                        unique_lines.extend(current_query)
-                        unique_lines.append('')
-                    current_query = [line]
-                else:
-                    # Duplicate query detected, skip
-                    current_query = []
-                    continue
-            elif current_query:
-                current_query.append(line)
-        
-        if current_query:
-            unique_lines.extend(current_query)
-        
-        # Join back and take first query if multiple detected
-        cleaned_query = '\n'.join(unique_lines).strip()
-        if not cleaned_query:
-            cleaned_query = query
-        
-        # If still has duplicates, just take first occurrence
-        if cleaned_query.count('RETURN') > 1:
-            first_return_idx = cleaned_query.find('RETURN')
-            second_match_idx = cleaned_query.find('MATCH', first_return_idx)
-            if second_match_idx > 0:
-                cleaned_query = cleaned_query[:second_match_idx].strip()
-        
-        return cleaned_query
+# Static instructions go first (and byte-identical across calls) so the provider's
+# automatic prompt-prefix cache can reuse them; only schema/question vary per request.
+CYPHER_SYSTEM_PROMPT = """Convert the user's question to a Neo4j Cypher query using the graph schema they provide.
 
-    def interpret_results(self, question: str, results: list) -> str:
-        """Interpret Neo4j results into natural language"""
-        import json
-        
-        # Format results as clean JSON without embeddings
-        if not results:
-            result_data = "No matching records found."
-        else:
-            # Check if results contain aggregated data (like COUNT) or patient records
-            first_result = results[0] if results else {}
-            
-            # If it's aggregated data (e.g., {"numberOfPatients": 100}), pass it directly
-            aggregate_keywords = ['count', 'number', 'total', 'sum', 'avg', 'average', 'min', 'max', 'frequency']
-            has_aggregate = isinstance(first_result, dict) and any(
-                any(keyword in key.lower() for keyword in aggregate_keywords)
-                for key in first_result.keys() if isinstance(key, str)
-            )
-            
-            if has_aggregate:
-                # Aggregated data - pass as-is
-                result_data = json.dumps(results, indent=2)
-            else:
-                # Patient records - extract ONLY firstName and lastName
-                # Limit names sent to LLM to reduce tokens, but keep accurate total count
-                total_count = len(results)  # Keep original count - this is the REAL count
-                max_names_to_show = 15  # Only send first 15 names to LLM (sample)
-                limited = results[:max_names_to_show] if total_count > max_names_to_show else results
-                
-                formatted_results = []
-                for item in limited:
-                    record = item
-                    # If single-key nested (e.g., {'p': {...}}), extract inner dict
-                    if isinstance(item, dict) and len(item) == 1:
-                        record = list(item.values())[0]
-                    
-                    # Extract ONLY name fields
-                    if isinstance(record, dict):
-                        clean_record = {}
-                        if 'firstName' in record:
-                            clean_record['firstName'] = record['firstName']
-                        if 'lastName' in record:
-                            clean_record['lastName'] = record['lastName']
-                        if clean_record:
-                            formatted_results.append(clean_record)
-                
-                # Format as simple JSON with ONLY names
-                # CRITICAL: Always show the REAL total count, even if we limit the list to 15 names
-                if total_count > max_names_to_show:
-                    result_data = f"Found {total_count} total patients. Here are the first {len(formatted_results)} names:\n{json.dumps(formatted_results, indent=2)}"
-                else:
-                    result_data = f"Found {total_count} total patients. Here are their names:\n{json.dumps(formatted_results, indent=2)}"
-        
-        # Debug: print what we're sending to LLM
-        print(f"   🔍 Result data length: {len(result_data)} chars")
-        print(f"   🔍 Result data preview: {result_data[:300]}")
-        
-        result_summary = result_data
-        
-        prompt = f"""You are a helpful healthcare data assistant. Answer the user's question ONLY using the data provided below.
+CRITICAL PROPERTY RULES:
+- Patient has NO 'age' property! Use birthDate and calculate age: duration.between(date(p.birthDate), date()).years
+- For "over 65": WHERE duration.between(date(p.birthDate), date()).years > 65
+- For "past year": WHERE e.stop > datetime() - duration({years: 1})
+- Observation category is 'vital-signs' (not 'blood pressure' or 'Blood Pressure')
 
-User's Question: {question}
+IMPORTANT Cypher Syntax Rules:
+- After WITH with aggregation (e.g., count(), sum()), you CANNOT reference variables from before the WITH clause
+- Example CORRECT: MATCH (p:Patient)-[:HAS_CONDITION]->(c:Condition) WITH p, count(c) as conditionCount WHERE conditionCount > 1 RETURN p
+- Example WRONG: MATCH (p:Patient)-[:HAD_ENCOUNTER]->(e:Encounter) WITH p, count(e) as numEncounters WHERE e.baseCost > 100 (CANNOT use 'e' after WITH)
+- When collecting variables in WITH, include ALL variables you need in RETURN: WITH p, count(c) as conditionCount, collect(c.description) as conditions
+- For counting patterns: NEVER use size() - ALWAYS use COUNT {}: 
+  * WRONG: size((c)<-[:HAS_CONDITION]-())
+  * CORRECT: COUNT { (c)<-[:HAS_CONDITION]-(:Patient) } as patientCount
+  * Example: MATCH (c:Condition) WITH c, COUNT { (c)<-[:HAS_CONDITION]-(:Patient) } as patientCount WHERE patientCount > 50 RETURN c.description, patientCount
+- RETURN must be at END of query - cannot have RETURN in middle then continue with more clauses
+- When returning Encounter nodes, always include readable fields: RETURN e.id, e.description, e.start, e.stop OR RETURN e (if you need full node)
+- For missing/null values: Use IS NULL or IS NOT NULL: WHERE e.stop IS NULL
+- CRITICAL: When returning patients, ALWAYS use RETURN DISTINCT p (the node), NEVER RETURN DISTINCT p.firstName, p.lastName
+- To get unique patients: RETURN DISTINCT p (returns unique patient nodes by their node identity)
+- WRONG: RETURN DISTINCT p.firstName, p.lastName (this only returns unique name combinations, will miss patients with duplicate names - DO NOT USE THIS!)
+- CORRECT: RETURN DISTINCT p (always use this for patient queries)
+- IMPORTANT: Patients can have conditions via HAS_CONDITION OR via Encounter-DIAGNOSED. Check both paths if needed:
+  * Example: MATCH (p:Patient)-[:HAS_CONDITION]->(c:Condition) WHERE toLower(c.description) CONTAINS 'diabetes' RETURN DISTINCT p
+  * OR: MATCH (p:Patient)-[:HAD_ENCOUNTER]->(e:Encounter)-[:DIAGNOSED]->(c:Condition) WHERE toLower(c.description) CONTAINS 'diabetes' RETURN DISTINCT p
+- Example CORRECT: MATCH (p:Patient)-[:HAS_CONDITION]->(c:Condition) WHERE toLower(c.description) CONTAINS 'diabetes' RETURN DISTINCT p
+- Example WRONG: MATCH (p:Patient)-[:HAS_CONDITION]->(c:Condition) WHERE toLower(c.description) CONTAINS 'diabetes' RETURN DISTINCT p.firstName, p.lastName (DO NOT USE - will return wrong count!)
 
-Data provided: {result_summary}
+MULTIPLE CONDITIONS (AND logic):
+- For "both X and Y": Use MATCH twice with WHERE on each, then return patients who match both
+- Example CORRECT: MATCH (p:Patient)-[:HAS_CONDITION]->(c1:Condition) WHERE toLower(c1.description) CONTAINS 'hypertension' WITH p MATCH (p)-[:HAS_CONDITION]->(c2:Condition) WHERE toLower(c2.description) CONTAINS 'obesity' RETURN p
+
+DATE/TIME CALCULATIONS:
+- Use duration() for date differences: duration.between(datetime(e.start), datetime(e.stop))
+- For "within 30 days": Use duration.between(...).days <= 30
+- For "past year": datetime() - duration({years: 1})
+- For condition duration: Use HAS_CONDITION relationship properties: (p)-[r:HAS_CONDITION]->(c) WHERE r.start and r.stop exist
+- Example: MATCH (p:Patient)-[r:HAS_CONDITION]->(c:Condition) WHERE r.start IS NOT NULL AND r.stop IS NOT NULL RETURN c.description, AVG(duration.between(datetime(r.start), datetime(r.stop)).days) as avgDuration
+- CRITICAL: When comparing dates between encounters/procedures, use encounter dates NOT patient birthDate
+- Example CORRECT (procedure within 30 days of diagnosis): MATCH (p:Patient)-[:HAD_ENCOUNTER]->(e1:Encounter)-[:DIAGNOSED]->(c:Condition), (p)-[:HAD_ENCOUNTER]->(e2:Encounter)-[:HAD_PROCEDURE]->(pr:Procedure) WHERE toLower(c.description) CONTAINS 'diabetes' AND duration.between(datetime(e1.stop), datetime(e2.start)).days <= 30 AND duration.between(datetime(e1.stop), datetime(e2.start)).days >= 0
+- Example WRONG: duration.between(datetime(e.stop), datetime(p.birthDate)) - NEVER compare encounter dates with birthDate!
 
-IMPORTANT - How to read the data:
+TEXT MATCHING RULES - ALWAYS USE CONTAINS:
+- NEVER use exact match {description: "value"} - ALWAYS use CONTAINS
+- Example CORRECT: WHERE toLower(c.description) CONTAINS 'diabetes'
+- Example WRONG: WHERE c.description = "Diabetes" OR {description: "Diabetes"}
+- Use case-insensitive matching: toLower(c.description) CONTAINS 'diabetes'
+- For blood pressure: WHERE toLower(o.description) CONTAINS 'blood pressure'
+- For cardiac/heart: Use toLower() with CONTAINS: WHERE toLower(e.reasonDescription) CONTAINS 'cardiac' OR toLower(e.reasonDescription) CONTAINS 'heart'
+- CRITICAL: When returning patients, ALWAYS use DISTINCT to avoid duplicates: MATCH (p:Patient)-[:HAS_CONDITION]->(c:Condition) WHERE toLower(c.description) CONTAINS 'diabetes' RETURN DISTINCT p.firstName, p.lastName
+- If a patient has multiple matching conditions, they'll appear multiple times without DISTINCT - ALWAYS use DISTINCT p or DISTINCT p.firstName, p.lastName
+- Example CORRECT: MATCH (p:Patient)-[:HAS_CONDITION]->(c:Condition) WHERE toLower(c.description) CONTAINS 'diabetes' RETURN DISTINCT p
+- Example WRONG: MATCH (p:Patient)-[:HAS_CONDITION]->(c:Condition) WHERE toLower(c.description) CONTAINS 'diabetes' RETURN p (missing DISTINCT - will return duplicates!)
+- IMPORTANT: When using toLower() on properties that might be NULL, check NULL first: WHERE o.category IS NOT NULL AND toLower(o.category) = 'vital-signs'
+- For Observation category: ALWAYS check NULL first! Use: WHERE (o.category IS NOT NULL AND toLower(o.category) = 'vital-signs') OR toLower(o.description) CONTAINS 'blood pressure'
+- NEVER use toLower() directly on properties that might be NULL without checking first
+- Example CORRECT: WHERE (o.category IS NOT NULL AND toLower(o.category) = 'vital-signs') OR toLower(o.description) CONTAINS 'blood pressure'
+- Example WRONG: WHERE toLower(o.category) = 'vital-signs' AND toLower(o.description) CONTAINS 'blood pressure' (will fail if category is NULL)
+
+ONLY USE RELATIONSHIPS THAT EXIST:
+- Available: HAD_ENCOUNTER, HAS_CONDITION, DIAGNOSED, UNDERWENT, HAD_PROCEDURE, HAS_OBSERVATION, RECORDED_OBSERVATION
+- Do NOT invent relationships like FOLLOWED_BY
+- For conditions followed by procedures: Use DIAGNOSED on Encounter, then HAD_PROCEDURE on same Encounter
+- Example: MATCH (e:Encounter)-[:DIAGNOSED]->(c:Condition), (e)-[:HAD_PROCEDURE]->(p:Procedure) WHERE duration.between(datetime(e.start), datetime(e.stop)).days <= 30
+
+COMMON QUERY PATTERNS:
+- Average conditions per patient: MATCH (p:Patient)-[:HAS_CONDITION]->(c:Condition) WITH p, count(c) as conditionCount RETURN avg(conditionCount) as averageConditionsPerPatient
+- Condition categories: Condition nodes don't have baseCost or totalCost - use Encounter.baseCost/totalCost instead. Example: MATCH (e:Encounter)-[:DIAGNOSED]->(c:Condition) WITH c, MAX(e.baseCost) as maxCost RETURN c.description, maxCost ORDER BY maxCost DESC
+- Average encounter cost per condition: MATCH (e:Encounter)-[:DIAGNOSED]->(c:Condition) WITH c, AVG(e.totalCost) as avgCost RETURN c.description, avgCost ORDER BY avgCost DESC
+- Missing dates: WHERE e.stop IS NULL (returns encounters with null stop dates). Always return readable fields: RETURN e.id, e.description, e.start, e.stop
+- When returning averages/counts, always return the value directly: RETURN avg(conditionCount) as averageConditionsPerPatient (not wrapped in another structure)
+- Conditions followed by procedures: Use Encounter as bridge - Conditions are DIAGNOSED on Encounters, Procedures are HAD_PROCEDURE on same Encounter
+- Example: MATCH (e:Encounter)-[:DIAGNOSED]->(c:Condition), (e)-[:HAD_PROCEDURE]->(p:Procedure) WHERE duration.between(datetime(e.start), datetime(e.stop)).days <= 30 RETURN DISTINCT c.description, p.description"""
+
+# Worked (question, cypher) pairs appended to the static prefix
+FEW_SHOTS: List[Tuple[str, str]] = [
+    (
+        "How many patients have diabetes?",
+        "MATCH (p:Patient)-[:HAS_CONDITION]->(c:Condition) WHERE toLower(c.description) CONTAINS 'diabetes' "
+        "RETURN count(DISTINCT p) AS numberOfPatients",
+    ),
+    (
+        "Which patients over 65 have hypertension?",
+        "MATCH (p:Patient)-[:HAS_CONDITION]->(c:Condition) WHERE toLower(c.description) CONTAINS 'hypertension' "
+        "AND duration.between(date(p.birthDate), date()).years > 65 RETURN DISTINCT p",
+    ),
+    (
+        "What is the average encounter cost per condition?",
+        "MATCH (e:Encounter)-[:DIAGNOSED]->(c:Condition) WITH c, AVG(e.totalCost) AS avgCost "
+        "RETURN c.description, avgCost ORDER BY avgCost DESC",
+    ),
+    (
+        "Which patients have both hypertension and obesity?",
+        "MATCH (p:Patient)-[:HAS_CONDITION]->(c1:Condition) WHERE toLower(c1.description) CONTAINS 'hypertension' "
+        "WITH p MATCH (p)-[:HAS_CONDITION]->(c2:Condition) WHERE toLower(c2.description) CONTAINS 'obesity' "
+        "RETURN DISTINCT p",
+    ),
+    (
+        "Which encounters are missing a stop date?",
+        "MATCH (e:Encounter) WHERE e.stop IS NULL RETURN e.id, e.description, e.start, e.stop",
+    ),
+]
+
+CYPHER_SYSTEM_PROMPT += "\n\nEXAMPLES:\n" + "\n\n".join(
+    f"Question: {question}\nCypher: {cypher}" for question, cypher in FEW_SHOTS
+) + "\n\nReturn ONLY the Cypher query, nothing else."
+
+
+# Static answer-format rules for interpret_results; only the question and data vary
+_INTERPRET_RULES = """IMPORTANT - How to read the data:
 - The FIRST LINE says "Found X total patients" - THAT NUMBER X IS THE ACCURATE ANSWER COUNT (use this number!)
 - The JSON array below contains ONLY THE FIRST FEW names (first 15 names) - NOT ALL names
 - DO NOT count the JSON array - it only has a partial list of names
@@ -249,5 +187,432 @@ Write naturally - don't just list names with commas. Make it sound like a real h
 
 Provide ONLY the direct, natural answer now:"""
 
+
+_NAME_FIELDS = ("firstName", "lastName")
+# Questions that only ask for the patient names, answered without an LLM call
+_LISTING_PREFIXES = (
+    "which patient", "list patient", "list all patient", "list the patient",
+    "name the patient", "who are the patient", "show patient", "show me patient",
+    "show all patient", "show me all patient",
+)
+_MAX_AGGREGATE_ROWS = 50
+# Result keys that mark aggregated data (e.g. numberOfPatients, avgCost)
+_AGGREGATE_KEY = re.compile(r"count|number|total|sum|avg|average|min|max|frequency", re.IGNORECASE)
+
+_NUMBER = re.compile(r"\d+(?:\.\d+)?")
+# Includes contractions ("don't", "doesn’t") and their apostrophe-less spellings
+_NEGATION = re.compile(
+    r"\b(?:not|no|without|never|none|nor|cannot|"
+    r"(?:do|does|did|is|are|was|were|have|has|had|ca|wo)nt)\b|\w+n['’]t\b",
+    re.IGNORECASE,
+)
+
+# Generation halts server-side as soon as a second query (or a terminator) begins
+_CYPHER_STOPS = ["\n\nMATCH ", "\n\nWITH ", "\n\nCALL ", ";"]
+_CODE_FENCE = re.compile(r"^```(?:cypher)?\s*|\s*```$", re.IGNORECASE)
+
+
+# A bare "RETURN [DISTINCT] var [SKIP n] [LIMIT n]" at the end of a query
+_BARE_RETURN = re.compile(
+    r"\bRETURN\s+(DISTINCT\s+)?([A-Za-z_]\w*)((?:\s+SKIP\s+\d+)?(?:\s+LIMIT\s+\d+)?)\s*$",
+    re.IGNORECASE,
+)
+
+
+def _project_patient_return(cypher: str) -> str:
+    """Return only the fields we use when a query would return whole Patient nodes.
+
+    id is kept so DISTINCT still collapses on patient identity rather than on name.
+    """
+    match = _BARE_RETURN.search(cypher)
+    if not match:
+        return cypher
+    distinct, var, tail = match.group(1) or "", match.group(2), match.group(3)
+    if not re.search(rf"\(\s*{re.escape(var)}\s*:\s*Patient\b", cypher):
+        return cypher
+    projection = f"{var}.id AS id, {var}.firstName AS firstName, {var}.lastName AS lastName"
+    return f"{cypher[:match.start()]}RETURN {distinct}{projection}{tail}"
+
+
+_SCHEMA_NODE_LINE = re.compile(r"^-?\s*([A-Za-z_]\w*)\(([^)]*)\)$")
+_SCHEMA_REL_LINE = re.compile(r"^-?\s*(\(\w+\)-\[:\w+(?:\s*\{[^}]*\})?\]->\(\w+\))$")
+_SCHEMA_HEADERS = {"Node Types", "Relationship Types", "Neo4j Healthcare Graph Schema Summary"}
+
+
+@lru_cache(maxsize=32)
+def _compact_schema(schema: str) -> str:
+    """Shorter schema for the prompt: one "Label(props)" / "(A)-[:REL]->(B)" list each.
+
+    Anything that isn't a node or relationship line is kept (whitespace-trimmed), and
+    everything from a "Context:" line onwards is passed through untouched.
+    """
+    body, sep, context = schema.partition("\nContext:\n")
+    labels: Dict[str, List[str]] = {}
+    rels: List[str] = []
+    other: List[str] = []
+    for raw in body.splitlines():
+        line = " ".join(raw.split())
+        if not line or line in _SCHEMA_HEADERS:
+            continue
+        node = _SCHEMA_NODE_LINE.match(line)
+        if node:
+            props = labels.setdefault(node.group(1), [])
+            for prop in node.group(2).split(","):
+                prop = prop.strip()
+                if prop and prop not in props:
+                    props.append(prop)
+            continue
+        rel = _SCHEMA_REL_LINE.match(line)
+        if rel:
+            rel_line = rel.group(1).replace(", ", ",")
+            if rel_line not in rels:
+                rels.append(rel_line)
+            continue
+        other.append(line)
+
+    if not labels:
+        return schema
+    parts = [
+        "Nodes: " + "; ".join(f"{label}({','.join(props)})" for label, props in labels.items()),
+        "Relationships: " + "; ".join(rels),
+    ]
+    parts.extend(other)
+    compact = "\n".join(parts)
+    return f"{compact}\n{sep}{context}" if sep else compact
+
+
+def _clean_cypher(text: str) -> str:
+    """Strip surrounding whitespace and a Markdown code fence, if any"""
+    return _CODE_FENCE.sub("", text.strip()).strip()
+
+
+@lru_cache(maxsize=4)
+def get_chat_model(model: str, api_key: str, temperature: float = 0) -> ChatOpenAI:
+    """Process-wide ChatOpenAI per (model, key, temperature), so its HTTP pool is shared"""
+    return ChatOpenAI(model=model, api_key=api_key, temperature=temperature)
+
+
+@lru_cache(maxsize=1)
+def _get_local_encoder():
+    """Load the local encoder once per process (384-d, fast on CPU)"""
+    return SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2")
+
+
+class PatientListAnswer(BaseModel):
+    """Structured fragment for patient-list answers"""
+    description: str = Field(
+        description="Short phrase describing the patients, without a count, e.g. 'with diabetes' "
+                    "or 'over 65 with hypertension'"
+    )
+
+
+class SemanticCypherCache:
+    """Reuse Cypher generated for a paraphrase of the question.
+
+    Entries only match when the schema digest is identical, the numbers and negations
+    in both questions agree ("over 65" vs "over 70" embed almost identically), and
+    cosine similarity exceeds the threshold.
+    """
+
+    def __init__(self, threshold: float = 0.95, max_entries: int = 1000):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._vecs: Optional[np.ndarray] = None  # (N, 384) float16, unit-normalized
+        self._keys: List[Tuple[bytes, Tuple[str, ...], bool]] = []
+        self._cypher: List[str] = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _guard_key(question: str, schema_digest: bytes) -> Tuple[bytes, Tuple[str, ...], bool]:
+        return schema_digest, tuple(_NUMBER.findall(question)), bool(_NEGATION.search(question))
+
+    def encode(self, question: str) -> np.ndarray:
+        return _get_local_encoder().encode(question, normalize_embeddings=True).astype(np.float32)
+
+    def lookup(self, vec: np.ndarray, question: str, schema_digest: bytes) -> Optional[str]:
+        guard = self._guard_key(question, schema_digest)
+        with self._lock:
+            if self._vecs is None:
+                return None
+            sims = self._vecs.astype(np.float32) @ vec
+            for idx in np.argsort(-sims):
+                if sims[idx] <= self.threshold:
+                    return None
+                if self._keys[idx] == guard:
+                    return self._cypher[idx]
+        return None
+
+    def add(self, vec: np.ndarray, question: str, schema_digest: bytes, cypher: str):
+        with self._lock:
+            row = vec.astype(np.float16)[None, :]
+            self._vecs = row if self._vecs is None else np.vstack([self._vecs, row])
+            self._keys.append(self._guard_key(question, schema_digest))
+            self._cypher.append(cypher)
+            # Drop the oldest entries beyond the cap
+            overflow = len(self._cypher) - self.max_entries
+            if overflow > 0:
+                self._vecs = self._vecs[overflow:]
+                del self._keys[:overflow]
+                del self._cypher[:overflow]
+
+    def clear(self):
+        with self._lock:
+            self._vecs = None
+            self._keys.clear()
+            self._cypher.clear()
+
+
+class CypherBatcher:
+    """Coalesce concurrent Cypher generations into one chat completion.
+
+    Requests arriving within ``max_wait`` seconds (up to ``max_batch``) that share a
+    schema are sent as a single JSON-mode prompt keyed by id. Anything the batch
+    answer misses is retried through ``single``.
+    """
+
+    def __init__(self, llm: ChatOpenAI, single: Callable[[str, str], str],
+                 max_batch: int = 8, max_wait: float = 0.25):
+        self.llm = llm.bind(response_format={"type": "json_object"})
+        self.single = single
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue: "queue.Queue[Tuple[str, str, Future]]" = queue.Queue()
+        self._pool = ThreadPoolExecutor(max_workers=max_batch)
+        self._worker: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def submit(self, question: str, schema: str) -> str:
+        future: Future = Future()
+        self._queue.put((question, schema, future))
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, daemon=True)
+                self._worker.start()
+        return future.result()
+
+    def _run(self):
+        while True:
+            pending = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(pending) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    pending.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            groups: Dict[str, list] = {}
+            for item in pending:
+                groups.setdefault(item[1], []).append(item)
+            for schema, items in groups.items():
+                self._pool.submit(self._dispatch, schema, items)
+
+    def _dispatch(self, schema: str, items: list):
+        answers: Dict[str, str] = {}
+        if len(items) > 1:
+            try:
+                answers = self._generate_batch(schema, [question for question, _, _ in items])
+            except Exception as e:
+                print(f"Batched Cypher generation failed, retrying individually: {e}")
+
+        for idx, (question, _, future) in enumerate(items, start=1):
+            try:
+                cypher = answers.get(str(idx)) or self.single(question, schema)
+                future.set_result(cypher)
+            except Exception as e:
+                future.set_exception(e)
+
+    def _generate_batch(self, schema: str, questions: List[str]) -> Dict[str, str]:
+        numbered = "\n".join(f"{i}. {q}" for i, q in enumerate(questions, start=1))
+        messages = [
+            SystemMessage(content=CYPHER_SYSTEM_PROMPT),
+            HumanMessage(content=(
+                f"Graph Schema:\n{schema}\n\n"
+                "Write one Cypher query for each question below. Return a JSON object "
+                'mapping each question number to its query, e.g. {"1": "MATCH ...", "2": "MATCH ..."}.\n\n'
+                f"Questions:\n{numbered}"
+            )),
+        ]
+        parsed = json.loads(self.llm.invoke(messages).content)
+        return {
+            str(key): _clean_cypher(value)
+            for key, value in parsed.items()
+            if isinstance(value, str) and value.strip()
+        }
+
+
+class LLMService:
+    def __init__(self):
+        settings = get_settings()
+        self.llm = get_chat_model("gpt-3.5-turbo", settings.openai_api_key)
+        # LRU of generated Cypher keyed by (normalized question, schema digest)
+        self._cypher_cache: "OrderedDict[Tuple[str, bytes], str]" = OrderedDict()
+        self._cypher_cache_size = 512
+        self._cypher_cache_lock = threading.Lock()
+        # Paraphrase-tolerant cache, only when a local encoder is installed
+        self._semantic_cache = SemanticCypherCache() if LOCAL_ENCODER_AVAILABLE else None
+        # Template fill for common question shapes (needs the same local encoder)
+        self._template_router = CypherTemplateRouter(
+            lambda texts: _get_local_encoder().encode(texts, normalize_embeddings=True)
+        ) if LOCAL_ENCODER_AVAILABLE else None
+        # Patient-list answers are rendered in Python around a structured fragment
+        self._list_llm = self.llm.with_structured_output(PatientListAnswer, method="function_calling")
+        # Cypher generation has its own (cheaper, pinned) model
+        if settings.cypher_ollama_model and OLLAMA_AVAILABLE:
+            self.cypher_llm = ChatOllama(model=settings.cypher_ollama_model, temperature=0)
+        else:
+            self.cypher_llm = get_chat_model(settings.cypher_model, settings.openai_api_key)
+        # A lone request goes straight to the LLM; overlapping ones are coalesced
+        # (batching relies on OpenAI JSON mode)
+        self._batcher = CypherBatcher(
+            self.cypher_llm, self._generate_single
+        ) if isinstance(self.cypher_llm, ChatOpenAI) else None
+        self._inflight = 0
+        self._inflight_lock = threading.Lock()
+
+    def clear_cache(self):
+        """Drop memoized Cypher (call after the graph schema changes)"""
+        with self._cypher_cache_lock:
+            self._cypher_cache.clear()
+        if self._semantic_cache is not None:
+            self._semantic_cache.clear()
+
+    def generate_cypher(self, question: str, schema: str) -> str:
+        """Generate Cypher query from natural language (memoized per question and schema)"""
+        schema = _compact_schema(schema)
+        schema_digest = hashlib.blake2b(schema.encode(), digest_size=8).digest()
+        key = (question.strip().lower(), schema_digest)
+        with self._cypher_cache_lock:
+            if key in self._cypher_cache:
+                self._cypher_cache.move_to_end(key)
+                return self._cypher_cache[key]
+
+        # Multi-line inputs are refinement prompts or carry conversation history;
+        # near-duplicates of those are not safe to answer with the same query
+        vec = None
+        if self._semantic_cache is not None and "\n" not in question.strip():
+            vec = self._semantic_cache.encode(question)
+            cypher = self._template_router.route(question, vec)
+            if cypher is not None:
+                return cypher
+            cypher = self._semantic_cache.lookup(vec, question, schema_digest)
+            if cypher is not None:
+                return cypher
+
+        cypher = _project_patient_return(self._generate_cypher_uncached(question, schema))
+
+        if vec is not None:
+            self._semantic_cache.add(vec, question, schema_digest, cypher)
+        with self._cypher_cache_lock:
+            self._cypher_cache[key] = cypher
+            self._cypher_cache.move_to_end(key)
+            while len(self._cypher_cache) > self._cypher_cache_size:
+                self._cypher_cache.popitem(last=False)
+        return cypher
+
+    def _generate_cypher_uncached(self, question: str, schema: str) -> str:
+        with self._inflight_lock:
+            self._inflight += 1
+            concurrent = self._inflight > 1
+        try:
+            if concurrent and self._batcher is not None:
+                return self._batcher.submit(question, schema)
+            return self._generate_single(question, schema)
+        finally:
+            with self._inflight_lock:
+                self._inflight -= 1
+
+    def _generate_single(self, question: str, schema: str) -> str:
+        messages = [
+            SystemMessage(content=CYPHER_SYSTEM_PROMPT),
+            HumanMessage(content=f"Graph Schema:\n{schema}\n\nQuestion: {question}"),
+        ]
+
+        response = self.cypher_llm.invoke(messages, stop=_CYPHER_STOPS)
+        return _clean_cypher(response.content)
+
+    def interpret_results(self, question: str, results: list) -> str:
+        """Interpret Neo4j results into natural language"""
+        # Format results as clean JSON without embeddings
+        if not results:
+            result_data = "No matching records found."
+        else:
+            # Check if results contain aggregated data (like COUNT) or patient records
+            first_result = results[0] if results else {}
+            
+            # If it's aggregated data (e.g., {"numberOfPatients": 100}), pass it directly
+            has_aggregate = isinstance(first_result, dict) and any(
+                _AGGREGATE_KEY.search(key) for key in first_result if isinstance(key, str)
+            )
+            
+            if has_aggregate:
+                # Aggregated data - pass as-is, but cap the rows so long breakdowns
+                # can't blow up the prompt; the true row count is stated up front
+                if len(results) > _MAX_AGGREGATE_ROWS:
+                    result_data = (
+                        f"Showing the first {_MAX_AGGREGATE_ROWS} of {len(results)} rows:\n"
+                        f"{json.dumps(results[:_MAX_AGGREGATE_ROWS], indent=2)}"
+                    )
+                else:
+                    result_data = json.dumps(results, indent=2)
+            else:
+                # Patient records - extract ONLY firstName and lastName
+                # Limit names sent to LLM to reduce tokens, but keep accurate total count
+                total_count = len(results)  # Keep original count - this is the REAL count
+                max_names_to_show = 15  # Only send first 15 names to LLM (sample)
+                limited = results[:max_names_to_show] if total_count > max_names_to_show else results
+                
+                # Unwrap single-key records (e.g. {'p': {...}}) and keep ONLY name fields, in one pass
+                formatted_results = [
+                    {field: record[field] for field in _NAME_FIELDS if field in record}
+                    for item in limited
+                    for record in ((next(iter(item.values())),) if isinstance(item, dict) and len(item) == 1 else (item,))
+                    if isinstance(record, dict) and ("firstName" in record or "lastName" in record)
+                ]
+                if formatted_results:
+                    # Count and names come from Python; the LLM only phrases who they are
+                    return self._render_patient_list(question, total_count, formatted_results)
+                result_data = f"Found {total_count} records, but no patients with names among them."
+        
+        # Debug: print what we're sending to LLM
+        print(f"   🔍 Result data length: {len(result_data)} chars")
+        print(f"   🔍 Result data preview: {result_data[:300]}")
+        
+        result_summary = result_data
+
+        prompt = f"""You are a helpful healthcare data assistant. Answer the user's question ONLY using the data provided below.
+
+User's Question: {question}
+
+Data provided: {result_summary}
+
+""" + _INTERPRET_RULES
+
         response = self.llm.invoke(prompt)
-        return response.content
\ No newline at end of file
+        return response.content
+
+    def _render_patient_list(self, question: str, total_count: int, names: List[dict]) -> str:
+        full_names = [" ".join(str(v) for v in (n.get("firstName"), n.get("lastName")) if v) for n in names]
+        description = ""
+        # Pure listing questions need no phrasing at all - answer without an LLM call
+        if not question.strip().lower().startswith(_LISTING_PREFIXES):
+            try:
+                answer = self._list_llm.invoke(
+                    f"Question: {question}\n\nDescribe the patients this question asks about."
+                )
+                description = answer.description.strip()
+            except Exception as e:
+                print(f"   ⚠️ Structured list answer failed: {e}")
+        subject = f"{'patient' if total_count == 1 else 'patients'}{' ' + description if description else ''}"
+        verb = "is" if total_count == 1 else "are"
+
+        if total_count > len(full_names):
+            return (
+                f"There {verb} {total_count} {subject}. These include {', '.join(full_names)}, "
+                f"and {total_count - len(full_names)} others."
+            )
+        if len(full_names) == 1:
+            return f"There {verb} {total_count} {subject}: {full_names[0]}."
+        return f"There {verb} {total_count} {subject}: {', '.join(full_names[:-1])} and {full_names[-1]}."
\ No newline at end of file
@@ -1,80 +1,347 @@
-from neo4j import GraphDatabase
-from typing import Dict
+import asyncio
+import copy
+import hashlib
+import re
+import threading
+
+from cachetools import TTLCache
+
+from functools import lru_cache
+from neo4j import AsyncDriver, AsyncGraphDatabase, Driver, GraphDatabase
+from neo4j.graph import Node, Relationship
+from typing import Dict, List, Optional
 
 from config import get_settings
 
 
+# Results larger than this aren't cached; the cache as a whole holds at most
+# _RESULT_CACHE_ROWS rows, so a few big generated queries can't pin memory
+_MAX_CACHED_ROWS = 1000
+_RESULT_CACHE_ROWS = 50_000
+
+# Queries that may change the graph; these bypass (and invalidate) the result cache
+_WRITE_CLAUSE = re.compile(
+    r"\b(?:CREATE|MERGE|DELETE|SET|REMOVE|DROP|LOAD\s+CSV|FOREACH)\b|\bCALL\s+apoc\.(?:periodic|create|merge|refactor)",
+    re.IGNORECASE,
+)
+
+
+@lru_cache(maxsize=1)
+def get_driver() -> Driver:
+    """Process-wide driver; every Neo4jService shares its connection pool"""
+    settings = get_settings()
+    return GraphDatabase.driver(
+        settings.neo4j_uri,
+        auth=(settings.neo4j_username, settings.neo4j_password),
+        max_connection_pool_size=50,
+        connection_acquisition_timeout=30,
+        connection_timeout=15,
+        max_transaction_retry_time=15,
+    )
+
+
+@lru_cache(maxsize=1)
+def get_async_driver() -> AsyncDriver:
+    """Process-wide async driver for the FastAPI event loop; mirrors get_driver()"""
+    settings = get_settings()
+    return AsyncGraphDatabase.driver(
+        settings.neo4j_uri,
+        auth=(settings.neo4j_username, settings.neo4j_password),
+        max_connection_pool_size=50,
+        connection_acquisition_timeout=30,
+        connection_timeout=15,
+        max_transaction_retry_time=15,
+    )
+
+
+# Vector and bookkeeping properties that stay inside Neo4j: query results, API responses
+# and prompts never carry them (embedding_q8 is raw bytes and isn't even JSON-serializable)
+HIDDEN_PROPERTIES = frozenset({
+    'embedding', 'embedding_q8', 'embedding_scale', '_text_repr', '_text_hash', '_row_hash',
+})
+
+
+def _public_properties(entity) -> Dict:
+    return {k: v for k, v in entity._properties.items() if k not in HIDDEN_PROPERTIES}
+
+
+def _properties_of(value):
+    # Typed column: a Node/Relationship, or null on an OPTIONAL MATCH miss
+    return _public_properties(value) if value is not None else None
+
+
 class Neo4jService:
+    # Introspected schema, shared by every instance until refreshed
+    _schema_str: Optional[str] = None
+    _schema_hash: Optional[str] = None
+    _schema_lock = threading.Lock()
+    # Read-query results, shared by every instance for a few minutes (sized in rows)
+    _result_cache: TTLCache = TTLCache(maxsize=_RESULT_CACHE_ROWS, ttl=300, getsizeof=len)
+    _result_cache_lock = threading.Lock()
+
     def __init__(self):
         settings = get_settings()
-        self.driver = GraphDatabase.driver(
-            settings.neo4j_uri,
-            auth=(settings.neo4j_username, settings.neo4j_password)
-        )
+        self.driver = get_driver()
+        self.database = settings.neo4j_database
+        # One long-lived session per thread (sessions are not thread-safe)
+        self._local = threading.local()
+        self._sessions = []
+        self._sessions_lock = threading.Lock()
 
-    def execute_query(self, cypher_query: str, parameters: Dict = None):
-        with self.driver.session() as session:
-            result = session.run(cypher_query, parameters or {})
-            print("Results", result)
-            records = []
-            for record in result:
-                data = {}
-                for key, value in record.items():
-                    # Convert Neo4j Node/Relationship objects to dicts
-                    if hasattr(value, '__dict__') and hasattr(value, '_properties'):
-                        # It's a Neo4j Node or Relationship
-                        data[key] = dict(value._properties)
-                    elif isinstance(value, list):
-                        # Handle lists (might contain Node objects)
-                        data[key] = [dict(v._properties) if hasattr(v, '_properties') else v for v in value]
-                    else:
-                        data[key] = value
-                records.append(data)
-            return records
+    def _session(self):
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self.driver.session(database=self.database)
+            self._local.session = session
+            with self._sessions_lock:
+                self._sessions.append(session)
+        return session
+
+    def _drop_session(self):
+        session = getattr(self._local, "session", None)
+        if session is None:
+            return
+        self._local.session = None
+        with self._sessions_lock:
+            if session in self._sessions:
+                self._sessions.remove(session)
+        try:
+            session.close()
+        except Exception:
+            pass
+
+    @staticmethod
+    def _to_python(value):
+        # Convert Neo4j Node/Relationship objects (or lists of them) to property dicts
+        if isinstance(value, (Node, Relationship)):
+            return _public_properties(value)
+        if isinstance(value, list):
+            return [_public_properties(v) if isinstance(v, (Node, Relationship)) else v for v in value]
+        return value
+
+    @classmethod
+    def _record_converter(cls, record):
+        """Build a record -> dict converter from the first record's column types.
+
+        Columns holding plain values skip conversion entirely on later rows; a column
+        that starts out null or as a list keeps the general conversion.
+        """
+        keys = record.keys()
+        handlers = []
+        for value in record.values():
+            if isinstance(value, (Node, Relationship)):
+                handlers.append(_properties_of)
+            elif value is None or isinstance(value, list):
+                handlers.append(cls._to_python)
+            else:
+                handlers.append(None)
+        if not any(handlers):
+            return lambda r: dict(zip(keys, r.values()))
+        pairs = list(zip(keys, handlers))
+
+        def convert(r):
+            return {key: handler(value) if handler else value
+                    for (key, handler), value in zip(pairs, r.values())}
+        return convert
+
+    @classmethod
+    def _convert_records(cls, result):
+        convert = None
+        for record in result:
+            if convert is None:
+                convert = cls._record_converter(record)
+            yield convert(record)
+
+    @classmethod
+    def clear_result_cache(cls):
+        """Forget cached read results (call after writes made outside execute_query)"""
+        with cls._result_cache_lock:
+            cls._result_cache.clear()
+
+    def execute_query(self, cypher_query: str, parameters: Dict = None, is_write: Optional[bool] = None):
+        """Run a query in a managed transaction so the driver retries transient errors.
+
+        is_write defaults to sniffing the query for write clauses.
+        """
+        if is_write is None:
+            is_write = bool(_WRITE_CLAUSE.search(cypher_query))
+        cache_key = None
+        if not is_write:
+            cache_key = (cypher_query, repr(sorted((parameters or {}).items())))
+            with self._result_cache_lock:
+                cached = self._result_cache.get(cache_key)
+            if cached is not None:
+                # Callers mutate the records they get back
+                return copy.deepcopy(cached)
+
+        def work(tx):
+            # Records must be materialized inside the transaction function
+            return list(self._convert_records(tx.run(cypher_query, parameters or {})))
+
+        try:
+            session = self._session()
+            records = session.execute_write(work) if is_write else session.execute_read(work)
+        except Exception:
+            # A failed session may be left in an unusable state; start fresh next time
+            self._drop_session()
+            raise
+
+        if is_write:
+            self.clear_result_cache()
+        elif len(records) <= _MAX_CACHED_ROWS:
+            with self._result_cache_lock:
+                self._result_cache[cache_key] = copy.deepcopy(records)
+        return records
+
+    def get_schema(self, refresh: bool = False) -> str:
+        """Compact schema summary from apoc.meta.schema(), computed once per process.
+
+        Returns "" when introspection is unavailable (e.g. APOC not installed).
+        """
+        cls = type(self)
+        with cls._schema_lock:
+            if cls._schema_str is None or refresh:
+                if refresh:
+                    # DDL or imports changed the graph; cached reads are stale too
+                    cls.clear_result_cache()
+                try:
+                    rows = self.execute_query("CALL apoc.meta.schema() YIELD value RETURN value")
+                    meta = rows[0]["value"] if rows else {}
+                    cls._schema_str = self._format_schema(meta)
+                except Exception as e:
+                    print(f"Schema introspection failed: {e}")
+                    cls._schema_str = ""
+                cls._schema_hash = hashlib.sha256(cls._schema_str.encode()).hexdigest()
+            return cls._schema_str
+
+    @staticmethod
+    def _format_schema(meta: Dict) -> str:
+        def props(entry):
+            # Internal bookkeeping and vector properties are noise for query generation
+            return ", ".join(
+                name for name in sorted(entry.get("properties", {}))
+                if not name.startswith(("_", "embedding"))
+            )
+
+        node_lines, rel_lines = [], []
+        for label in sorted(meta):
+            entry = meta[label]
+            # Embeddable only tags nodes carrying a vector; it isn't a domain type
+            if entry.get("type") != "node" or label == "Embeddable":
+                continue
+            node_lines.append(f"- {label}({props(entry)})")
+            for rel_type in sorted(entry.get("relationships", {})):
+                rel = entry["relationships"][rel_type]
+                if rel.get("direction") != "out":
+                    continue
+                rel_props = props(meta.get(rel_type, {}))
+                rel_props = f" {{{rel_props}}}" if rel_props else ""
+                for target in sorted(t for t in rel.get("labels", []) if t != "Embeddable"):
+                    rel_lines.append(f"- ({label})-[:{rel_type}{rel_props}]->({target})")
+
+        if not node_lines:
+            return ""
+        return "Node Types\n" + "\n".join(node_lines) + "\n\nRelationship Types\n" + "\n".join(rel_lines)
+
+    def iter_query(self, cypher_query: str, parameters: Dict = None, fetch_size: int = 1000):
+        """Yield records lazily; the server sends them in pages of fetch_size.
+
+        Uses its own session so a half-consumed generator can't clash with execute_query.
+        """
+        with self.driver.session(database=self.database, fetch_size=fetch_size) as session:
+            yield from self._convert_records(session.run(cypher_query, parameters or {}))
 
     def fetch_all_nodes(self):
+        """Stream every node as {id, label, properties} (a generator, not a list)"""
         query = (
-            "MATCH (n) RETURN id(n) as id, labels(n)[0] as label, properties(n) as properties"
+            "MATCH (n) RETURN id(n) as id, [l IN labels(n) WHERE l <> 'Embeddable'][0] as label, "
+            "properties(n) as properties"
         )
-        return self.execute_query(query)
+        return self.iter_query(query)
 
     def expand_subgraph(self, node_ids, depth: int = 1):
-        ids_csv = ",".join(str(i) for i in node_ids)
-        query = f"""
-        MATCH (n) WHERE id(n) IN [{ids_csv}]
-        CALL apoc.path.subgraphAll(n, {{maxLevel: {depth}}}) YIELD nodes, relationships
+        params = {"ids": list(node_ids), "depth": depth}
+        query = """
+        MATCH (n) WHERE id(n) IN $ids
+        CALL apoc.path.subgraphAll(n, {maxLevel: $depth}) YIELD nodes, relationships
         WITH nodes, relationships
-        RETURN [x IN nodes | {{id: id(x), label: labels(x)[0], properties: properties(x)}}] AS nodes,
-               [r IN relationships | {{start: id(startNode(r)), end: id(endNode(r)), type: type(r)}}] AS relationships
+        RETURN [x IN nodes | {id: id(x), label: labels(x)[0], properties: properties(x)}] AS nodes,
+               [r IN relationships | {start: id(startNode(r)), end: id(endNode(r)), type: type(r)}] AS relationships
         LIMIT 1
         """
         # Fallback if APOC not available: simple 1-hop traversal
         try:
-            results = self.execute_query(query)
+            results = self.execute_query(query, params)
             if results:
                 return results[0]
         except Exception:
             pass
 
-        # Simple fallback traversal without APOC
-        query_fallback = f"""
-        MATCH (n)-[r]-(m)
-        WHERE id(n) IN [{ids_csv}]
-        RETURN collect(distinct { {id: id(n), label: labels(n)[0], properties: properties(n)} }) as start_nodes,
-               collect(distinct { {id: id(m), label: labels(m)[0], properties: properties(m)} }) as neighbor_nodes,
-               collect(distinct { {start: id(startNode(r)), end: id(endNode(r)), type: type(r)} }) as relationships
+        # Simple fallback traversal without APOC; nodes are deduplicated server-side
+        query_fallback = """
+        MATCH (n) WHERE id(n) IN $ids
+        OPTIONAL MATCH (n)-[r]-(m)
+        WITH collect(DISTINCT n) + collect(DISTINCT m) AS ns,
+             collect(DISTINCT CASE WHEN r IS NULL THEN null
+                  ELSE {start: id(startNode(r)), end: id(endNode(r)), type: type(r)} END) AS relationships
+        UNWIND ns AS x
+        WITH DISTINCT x, relationships
+        RETURN collect({id: id(x), label: labels(x)[0], properties: properties(x)}) AS nodes, relationships
         """
-        res = self.execute_query(query_fallback)
+        res = self.execute_query(query_fallback, params)
         if not res:
             return {"nodes": [], "relationships": []}
-        start_nodes = res[0].get("start_nodes", [])
-        neighbor_nodes = res[0].get("neighbor_nodes", [])
-        relationships = res[0].get("relationships", [])
-        # Merge unique nodes by id
-        seen = {}
-        for n in start_nodes + neighbor_nodes:
-            seen[n["id"]] = n
-        return {"nodes": list(seen.values()), "relationships": relationships}
+        return {"nodes": res[0].get("nodes", []), "relationships": res[0].get("relationships", [])}
 
     def close(self):
-        self.driver.close()
+        with self._sessions_lock:
+            sessions, self._sessions = self._sessions, []
+            self._local = threading.local()
+        for session in sessions:
+            try:
+                session.close()
+            except Exception:
+                pass
+        # The shared driver stays open for other services
+
+
+class AsyncNeo4jService:
+    """Async counterpart of Neo4jService for FastAPI handlers.
+
+    Independent queries can be awaited together with execute_many instead of
+    blocking a worker thread per call.
+    """
+
+    def __init__(self):
+        settings = get_settings()
+        self.driver = get_async_driver()
+        self.database = settings.neo4j_database
+
+    async def execute_query(self, cypher_query: str, parameters: Dict = None, is_write: Optional[bool] = None):
+        if is_write is None:
+            is_write = bool(_WRITE_CLAUSE.search(cypher_query))
+
+        async def work(tx):
+            result = await tx.run(cypher_query, parameters or {})
+            records, convert = [], None
+            async for record in result:
+                if convert is None:
+                    convert = Neo4jService._record_converter(record)
+                records.append(convert(record))
+            return records
+
+        # Async sessions can't be shared between concurrent coroutines, so one per query
+        async with self.driver.session(database=self.database) as session:
+            if is_write:
+                records = await session.execute_write(work)
+                # Cached sync reads may now be stale
+                Neo4jService.clear_result_cache()
+                return records
+            return await session.execute_read(work)
+
+    async def execute_many(self, queries: List[str]) -> List[list]:
+        return await asyncio.gather(*(self.execute_query(q) for q in queries))
+
+    async def close(self):
+        # The shared driver stays open for other requests
+        pass
@@ -1,9 +1,44 @@
 """Neo4j-native vector store service using Neo4j vector indexes (like the mentor's notebooks)"""
-from typing import List, Dict, Any, Optional
+import hashlib
+import logging
+import os
+import threading
+from functools import lru_cache
+from itertools import islice
+from typing import List, Dict, Any, Optional, Tuple
+
+import numpy as np
+
 from services.neo4j_service import Neo4jService
-from services.embedding_service import EmbeddingService
+from services.embedding_service import EmbeddingService, quantize_int8
 from config import get_settings
 
+log = logging.getLogger(__name__)
+
+# Optional: in-process HNSW index for when Neo4j can't score vectors itself
+try:
+    import hnswlib
+    HNSW_AVAILABLE = True
+except ImportError:
+    HNSW_AVAILABLE = False
+
+
+def _top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k highest scores, best first: O(N) partition, then sort only k"""
+    if k <= 0:
+        return np.empty(0, dtype=np.intp)
+    if k >= scores.shape[0]:
+        return np.argsort(-scores)
+    top = np.argpartition(scores, -k)[-k:]
+    return top[np.argsort(-scores[top])]
+
+
+def _unit(vector) -> np.ndarray:
+    """L2-normalized float32 copy, so cosine similarity is a plain dot product"""
+    v = np.asarray(vector, dtype=np.float32)
+    norm = float(np.linalg.norm(v))
+    return v / norm if norm > 0 else v
+
 
 class Neo4jVectorStoreService:
     """Vector store using Neo4j native vector indexes (aligned with mentor's approach)"""
@@ -14,146 +49,369 @@ class Neo4jVectorStoreService:
         self.settings = get_settings()
         self.index_name = "node_embeddings"
         self.embedding_property = "embedding"
+        # Every embedded node also gets this label, which the vector index is scoped to
+        self.label = "Embeddable"
+        self._dimensions: Optional[int] = None
+        # Set once the vector index is confirmed, so upserts skip SHOW VECTOR INDEXES
+        self._index_ready = False
+        # Fallback search scores the int8 copy (embedding_q8 / embedding_scale)
+        self.quantized_fallback = True
+        # Repeated questions skip the embedding round-trip; keyed by (model, query)
+        self._query_embeddings = lru_cache(maxsize=1024)(self._embed_query_uncached)
+        # Local ANN index (source of truth stays Neo4j); rebuilt when an upsert stamps newer
+        self.hnsw_path = os.path.join("./.embed_cache", f"hnsw_{self.index_name}.bin")
+        self._hnsw_stamp_path = self.hnsw_path + ".stamp"
+        self._hnsw = None
+        self._hnsw_loaded_at = 0.0
+        self._hnsw_lock = threading.Lock()
         
+    @property
+    def dimensions(self) -> int:
+        """Embedding size of the configured model, probed once (the probe is cached on disk)"""
+        if self._dimensions is None:
+            self._dimensions = len(self.embedding_service.embed_text("probe"))
+        return self._dimensions
+
     def ensure_vector_index(self):
         """Create vector index if it doesn't exist (like notebook Lesson 3)"""
+        if self._index_ready:
+            return
         try:
             # Check if index already exists
             indexes = self.neo4j_service.execute_query("SHOW VECTOR INDEXES")
             index_names = [idx.get('name', '') for idx in indexes if isinstance(idx, dict)]
             
             if self.index_name not in index_names:
-                # Create vector index (same approach as notebooks)
+                # Label-scoped index: only nodes we embedded (tagged :Embeddable) are indexed
                 create_index_query = f"""
                 CREATE VECTOR INDEX {self.index_name} IF NOT EXISTS
-                FOR (n) ON (n.{self.embedding_property}) 
+                FOR (n:{self.label}) ON (n.{self.embedding_property}) 
                 OPTIONS {{ indexConfig: {{
-                    `vector.dimensions`: 1536,
+                    `vector.dimensions`: {int(self.dimensions)},
                     `vector.similarity_function`: 'cosine'
                 }}}}
                 """
                 self.neo4j_service.execute_query(create_index_query)
-                print(f"✅ Created vector index: {self.index_name}")
+                log.debug("Created vector index: %s", self.index_name)
             else:
-                print(f"✅ Vector index already exists: {self.index_name}")
-        except Exception as e:
-            print(f"⚠️  Could not create vector index (may require Neo4j 5.11+ or GDS): {e}")
+                log.debug("Vector index already exists: %s", self.index_name)
+            self._index_ready = True
+        except Exception:
+            log.warning("Could not create vector index (may require Neo4j 5.11+ or GDS)", exc_info=True)
             # Fallback: continue without native index, use property-based search
     
+    def _upsert_query(self) -> str:
+        return f"""
+        UNWIND $rows AS r
+        MATCH (n) WHERE id(n) = r.id
+        SET n:{self.label},
+            n.{self.embedding_property} = r.emb,
+            n.{self.embedding_property}_q8 = r.q8,
+            n.{self.embedding_property}_scale = r.scale,
+            n._text_repr = r.t,
+            n._text_hash = r.h
+        """
+
+    def _search_query(self) -> str:
+        return f"""
+        CALL db.index.vector.queryNodes(
+            '{self.index_name}', 
+            $top_k, 
+            $query_embedding
+        ) YIELD node, score
+        RETURN id(node) as id, score, [l IN labels(node) WHERE l <> '{self.label}'][0] as label,
+               properties(node) as properties
+        ORDER BY score DESC
+        LIMIT $top_k
+        """
+
+    def _batch_texts(self, batch: List[Dict[str, Any]]) -> List[str]:
+        # Create text representations for embedding (limit text length). Our own vector and
+        # bookkeeping properties are left out, or the text would change after every upsert
+        texts = []
+        for node in batch:
+            label = node.get("label", "Node")
+            if label == self.label:
+                label = "Node"
+            properties = {k: v for k, v in (node.get("properties") or {}).items()
+                          if not k.startswith(("_", self.embedding_property))}
+            texts.append(self._node_text_representation(label, properties)[:500])
+        return texts
+
+    def _text_hash(self, text: str) -> int:
+        # Signed 64-bit so it round-trips as a Neo4j INTEGER; the model is part of the key
+        digest = hashlib.blake2b(f"{self.embedding_service.model}\x00{text}".encode(), digest_size=8).digest()
+        return int.from_bytes(digest, "big", signed=True)
+
+    def _changed_only(self, batch: List[Dict[str, Any]], texts: List[str],
+                      stored: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], List[str], List[int]]:
+        """Drop nodes whose stored text hash matches (and that already have an embedding)"""
+        current = {row["id"]: row["h"] for row in stored if row.get("has_emb")}
+        keep_nodes, keep_texts, hashes = [], [], []
+        for node, text in zip(batch, texts):
+            text_hash = self._text_hash(text)
+            if current.get(node.get("id")) != text_hash:
+                keep_nodes.append(node)
+                keep_texts.append(text)
+                hashes.append(text_hash)
+        return keep_nodes, keep_texts, hashes
+
+    def _stored_hashes_query(self) -> str:
+        return f"""
+        MATCH (n) WHERE id(n) IN $ids
+        RETURN id(n) AS id, n._text_hash AS h, n.{self.embedding_property} IS NOT NULL AS has_emb
+        """
+
+    @staticmethod
+    def _upsert_rows(batch: List[Dict[str, Any]], texts: List[str], hashes: List[int],
+                     embeddings: List[List[float]]) -> List[Dict[str, Any]]:
+        rows = []
+        for node, text, text_hash, embedding in zip(batch, texts, hashes, embeddings):
+            # Stored unit-length, plus an int8 copy (per-vector scale) for the fallback scan
+            embedding = _unit(embedding)
+            scale, quantized = quantize_int8(embedding)
+            rows.append({
+                "id": node.get("id"),
+                "emb": embedding.tolist(),
+                "q8": quantized.tobytes(),
+                "scale": scale,
+                "t": text,
+                "h": text_hash
+            })
+        return rows
+
+    @staticmethod
+    def _hits(results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        return [
+            {
+                "id": result.get("id"),
+                "score": result.get("score", 0.0),
+                "label": result.get("label"),
+                "properties": result.get("properties", {})
+            }
+            for result in results
+        ]
+
+    def _embed_query_uncached(self, model: str, query: str) -> tuple:
+        return tuple(_unit(self.embedding_service.embed_text(query)).tolist())
+
+    def embed_query(self, query: str) -> List[float]:
+        """Unit-length query embedding, memoized per embedding model"""
+        return list(self._query_embeddings(self.embedding_service.model, query))
+
     def upsert_nodes(self, nodes: List[Dict[str, Any]]):
         """Store embeddings directly on Neo4j nodes (like notebook)"""
         self.ensure_vector_index()
         
-        batch_size = 1  # Small batches to avoid token limits
+        # One embedding request and one UNWIND write per batch
+        batch_size = 256
+        upsert_query = self._upsert_query()
         for i in range(0, len(nodes), batch_size):
             batch = nodes[i:i + batch_size]
-            for node in batch:
-                node_id = node.get("id")
-                label = node.get("label", "Node")
-                properties = node.get("properties", {})
-                
-                # Create text representation for embedding
-                text_repr = self._node_text_representation(label, properties)
-                
-                # Generate embedding
-                try:
-                    embedding = self.embedding_service.embed_text(text_repr[:500])  # Limit text length
-                    
-                    # Store embedding as property on node (like notebook's taglineEmbedding)
-                    # Use node internal ID to find and update
-                    upsert_query = f"""
-                    MATCH (n) WHERE id(n) = $node_id
-                    SET n.{self.embedding_property} = $embedding,
-                        n._text_repr = $text_repr
-                    RETURN id(n) as id
-                    """
-                    self.neo4j_service.execute_query(upsert_query, {
-                        "node_id": node_id,
-                        "embedding": embedding,
-                        "text_repr": text_repr[:500]
-                    })
-                except Exception as e:
-                    print(f"⚠️  Failed to embed node {node_id}: {e}")
+            # Offsets into nodes; batch shrinks below once unchanged nodes are dropped
+            end = i + len(batch) - 1
+            texts = self._batch_texts(batch)
+            try:
+                # Skip nodes whose text (and so embedding) hasn't changed since the last upsert
+                stored = self.neo4j_service.execute_query(
+                    self._stored_hashes_query(), {"ids": [node.get("id") for node in batch]}
+                )
+                batch, texts, hashes = self._changed_only(batch, texts, stored)
+                if not batch:
                     continue
+                embeddings = self.embedding_service.embed_texts(texts)
+                self.neo4j_service.execute_query(
+                    upsert_query, {"rows": self._upsert_rows(batch, texts, hashes, embeddings)}
+                )
+            except Exception:
+                log.warning("Failed to embed nodes %d-%d", i, end, exc_info=True)
+                continue
         
-        print(f"✅ Stored embeddings for {len(nodes)} nodes in Neo4j")
-    
+        self._invalidate_hnsw()
+        log.debug("Stored embeddings for %d nodes in Neo4j", len(nodes))
+
     def similarity_search(self, query: str, top_k: int = 5) -> List[Dict[str, Any]]:
         """Search using Neo4j vector index (like notebook's db.index.vector.queryNodes)"""
         try:
             # Generate query embedding
-            query_embedding = self.embedding_service.embed_text(query)
+            query_embedding = self.embed_query(query)
             
             # Use Neo4j vector index search (like notebook Lesson 3)
-            search_query = f"""
-            CALL db.index.vector.queryNodes(
-                '{self.index_name}', 
-                $top_k, 
-                $query_embedding
-            ) YIELD node, score
-            RETURN id(node) as id, score, labels(node)[0] as label, properties(node) as properties
-            ORDER BY score DESC
-            LIMIT $top_k
-            """
-            
-            results = self.neo4j_service.execute_query(search_query, {
+            results = self.neo4j_service.execute_query(self._search_query(), {
                 "query_embedding": query_embedding,
                 "top_k": top_k
             })
+            return self._hits(results)
             
-            hits = []
-            for result in results:
-                hits.append({
-                    "id": result.get("id"),
-                    "score": result.get("score", 0.0),
-                    "label": result.get("label"),
-                    "properties": result.get("properties", {})
-                })
-            
-            return hits
-            
-        except Exception as e:
+        except Exception:
             # Fallback: property-based cosine similarity if vector index not available
-            print(f"⚠️  Vector index search failed, using fallback: {e}")
+            log.warning("Vector index search failed, using fallback", exc_info=True)
             return self._fallback_similarity_search(query, top_k)
-    
+
     def _fallback_similarity_search(self, query: str, top_k: int = 5) -> List[Dict[str, Any]]:
-        """Fallback similarity search using cosine similarity (pure Python)"""
-        query_embedding = self.embedding_service.embed_text(query)
+        """Fallback similarity search without the vector index.
+
+        Scores inside Neo4j with vector.similarity.cosine (5.18+) so only the top hits
+        come back; older servers use a local HNSW index (if hnswlib is installed) or NumPy.
+        """
+        query_embedding = self.embed_query(query)
+        try:
+            results = self.neo4j_service.execute_query(f"""
+            MATCH (n:{self.label})
+            WHERE n.{self.embedding_property} IS NOT NULL
+            WITH n, vector.similarity.cosine(n.{self.embedding_property}, $query_embedding) AS score
+            ORDER BY score DESC
+            LIMIT $top_k
+            RETURN id(n) as id, score, [l IN labels(n) WHERE l <> '{self.label}'][0] as label,
+                   properties(n) as properties
+            """, {"query_embedding": query_embedding, "top_k": top_k})
+            return self._hits(results)
+        except Exception:
+            log.warning("vector.similarity.cosine unavailable, scoring locally", exc_info=True)
+        if HNSW_AVAILABLE:
+            try:
+                return self._hnsw_similarity_search(query_embedding, top_k)
+            except Exception:
+                log.warning("Local HNSW search failed, scoring in NumPy", exc_info=True)
+        return self._client_side_similarity_search(query_embedding, top_k)
+
+    def _invalidate_hnsw(self):
+        """Mark the on-disk HNSW index stale (called after every upsert)"""
+        if not HNSW_AVAILABLE:
+            return
+        os.makedirs(os.path.dirname(self._hnsw_stamp_path), exist_ok=True)
+        with open(self._hnsw_stamp_path, "a"):
+            os.utime(self._hnsw_stamp_path, None)
+        with self._hnsw_lock:
+            self._hnsw = None
+
+    def _hnsw_index(self):
+        stamp = os.path.getmtime(self._hnsw_stamp_path) if os.path.exists(self._hnsw_stamp_path) else 0.0
+        with self._hnsw_lock:
+            if self._hnsw is not None and self._hnsw_loaded_at >= stamp:
+                return self._hnsw
+
+            if os.path.exists(self.hnsw_path) and os.path.getmtime(self.hnsw_path) >= stamp:
+                index = hnswlib.Index(space="cosine", dim=self.dimensions)
+                index.load_index(self.hnsw_path)
+            else:
+                # Build from Neo4j, streaming the vectors
+                ids, vectors = [], []
+                for row in self.neo4j_service.iter_query(
+                    f"MATCH (n:{self.label}) WHERE n.{self.embedding_property} IS NOT NULL "
+                    f"RETURN id(n) AS id, n.{self.embedding_property} AS embedding"
+                ):
+                    ids.append(row["id"])
+                    vectors.append(row["embedding"])
+                if not ids:
+                    return None
+                data = np.asarray(vectors, dtype=np.float32)
+                index = hnswlib.Index(space="cosine", dim=data.shape[1])
+                index.init_index(max_elements=len(ids), M=16, ef_construction=200)
+                index.add_items(data, np.asarray(ids, dtype=np.int64))
+                os.makedirs(os.path.dirname(self.hnsw_path), exist_ok=True)
+                index.save_index(self.hnsw_path)
+            index.set_ef(64)
+            self._hnsw = index
+            self._hnsw_loaded_at = os.path.getmtime(self.hnsw_path)
+            return index
+
+    def _hnsw_similarity_search(self, query_embedding: List[float], top_k: int = 5) -> List[Dict[str, Any]]:
+        index = self._hnsw_index()
+        if index is None:
+            return []
+        k = min(top_k, index.get_current_count())
+        labels, distances = index.knn_query(np.asarray(query_embedding, dtype=np.float32), k=k)
+        scores = {int(node_id): 1.0 - float(dist) for node_id, dist in zip(labels[0], distances[0])}
+
+        # Properties for the hits in one round-trip, then restore the ANN ordering
+        rows = self.neo4j_service.execute_query(f"""
+        UNWIND $ids AS node_id
+        MATCH (n) WHERE id(n) = node_id
+        RETURN id(n) as id, [l IN labels(n) WHERE l <> '{self.label}'][0] as label, properties(n) as properties
+        """, {"ids": list(scores)})
+        for row in rows:
+            row["score"] = scores[row["id"]]
+        rows.sort(key=lambda row: row["score"], reverse=True)
+        return self._hits(rows)
+
+    def _client_side_similarity_search(self, query_embedding: List[float], top_k: int = 5) -> List[Dict[str, Any]]:
+        """Cosine similarity over up to 100 embedded nodes, computed in NumPy.
+
+        Scores int8-quantized embeddings by default; set ``quantized_fallback = False``
+        to score full float32 vectors instead (e.g. to check recall).
+        """
+        q = np.asarray(query_embedding, dtype=np.float32)
+        dim = q.shape[0]
         
-        # Get nodes with embeddings
+        # Get nodes with embeddings (the compact int8 copy when available)
+        if self.quantized_fallback:
+            vector_columns = (
+                f"n.{self.embedding_property}_q8 as embedding_q8, "
+                f"n.{self.embedding_property}_scale as embedding_scale, "
+                f"CASE WHEN n.{self.embedding_property}_q8 IS NULL THEN n.{self.embedding_property} END as embedding"
+            )
+        else:
+            vector_columns = f"n.{self.embedding_property} as embedding"
+        # Properties as [key, value] pairs without the vectors and bookkeeping, so each
+        # row carries only the one vector column (maps can't be filtered in plain Cypher)
         nodes_query = f"""
         MATCH (n)
         WHERE n.{self.embedding_property} IS NOT NULL
-        RETURN id(n) as id, labels(n)[0] as label, properties(n) as properties, n.{self.embedding_property} as embedding
+        RETURN id(n) as id, [l IN labels(n) WHERE l <> '{self.label}'][0] as label,
+               [k IN keys(n) WHERE NOT k STARTS WITH '{self.embedding_property}' AND NOT k STARTS WITH '_'
+                | [k, n[k]]] as property_pairs,
+               {vector_columns}
         LIMIT 100
         """
         
-        nodes = self.neo4j_service.execute_query(nodes_query)
+        nodes = self.neo4j_service.iter_query(nodes_query)
         
-        # Calculate cosine similarity (pure Python, no numpy needed)
-        hits = []
+        # Parallel arrays: row i of the matrix belongs to ids[i] / labels[i] / props[i]
+        ids, labels, props, vectors, scales = [], [], [], [], []
         for node in nodes:
-            node_embedding = node.get("embedding")
-            if node_embedding and isinstance(node_embedding, list):
-                # Dot product
-                dot_product = sum(a * b for a, b in zip(query_embedding, node_embedding))
-                # Magnitudes
-                norm_q = sum(x * x for x in query_embedding) ** 0.5
-                norm_n = sum(x * x for x in node_embedding) ** 0.5
-                # Cosine similarity
-                if norm_q > 0 and norm_n > 0:
-                    similarity = dot_product / (norm_q * norm_n)
-                    hits.append({
-                        "id": node.get("id"),
-                        "score": float(similarity),
-                        "label": node.get("label"),
-                        "properties": node.get("properties", {})
-                    })
+            packed = node.get("embedding_q8")
+            embedding = node.get("embedding")
+            scale = node.get("embedding_scale")
+            if packed is not None and scale is not None and len(packed) == dim:
+                vector = np.frombuffer(bytes(packed), dtype=np.int8)
+            elif isinstance(embedding, list) and len(embedding) == dim:
+                if self.quantized_fallback:
+                    scale, vector = quantize_int8(_unit(embedding))
+                else:
+                    vector = _unit(embedding)
+            else:
+                continue
+            ids.append(node.get("id"))
+            labels.append(node.get("label"))
+            props.append(dict(node.get("property_pairs") or []))
+            vectors.append(vector)
+            scales.append(scale)
+        if not vectors:
+            return []
+        
+        # Stored vectors and the query are unit-length, so cosine is one matmul with no norms
+        if self.quantized_fallback:
+            # Integer dot products (int32 accumulators), rescaled by the per-vector scales
+            matrix = np.asarray(vectors, dtype=np.int8).astype(np.int32)
+            q_scale, q8 = quantize_int8(q)
+            scores = (matrix @ q8.astype(np.int32)).astype(np.float32)
+            scores *= np.asarray(scales, dtype=np.float32) * q_scale
+        else:
+            matrix = np.asarray(vectors, dtype=np.float32)
+            scores = matrix @ q
         
-        # Sort by score descending
-        hits.sort(key=lambda x: x["score"], reverse=True)
-        return hits[:top_k]
+        # Hit dicts are only built for the selected rows
+        top = _top_k_indices(scores, min(top_k, len(vectors)))
+        return [
+            {
+                "id": ids[i],
+                "score": float(scores[i]),
+                "label": labels[i],
+                "properties": props[i]
+            }
+            for i in top
+        ]
     
     @staticmethod
     def _node_text_representation(label: Optional[str], properties: Dict[str, Any]) -> str:
@@ -162,16 +420,18 @@ class Neo4jVectorStoreService:
         if label:
             parts.append(f"Label: {label}")
         if properties:
-            for k, v in list(properties.items())[:10]:  # Limit properties
+            for k, v in islice(properties.items(), 10):  # Limit properties
                 if v is not None:
-                    val_str = str(v)[:100]  # Truncate long values
+                    val_str = str(v)
+                    if len(val_str) > 100:
+                        val_str = val_str[:100]  # Truncate long values
                     parts.append(f"{k}: {val_str}")
         return "\n".join(parts) if parts else "(empty)"
     
     def count(self) -> int:
         """Count nodes with embeddings"""
         result = self.neo4j_service.execute_query(
-            f"MATCH (n) WHERE n.{self.embedding_property} IS NOT NULL RETURN count(n) as count"
+            f"MATCH (n:{self.label}) WHERE n.{self.embedding_property} IS NOT NULL RETURN count(n) as count"
         )
         return result[0].get("count", 0) if result else 0
 
@@ -1,3 +1,4 @@
+from itertools import islice
 from typing import List, Dict, Any, Optional
 
 import chromadb
@@ -18,8 +19,10 @@ class VectorStoreService:
         self.embedding_service = EmbeddingService()
 
     def upsert_nodes(self, nodes: List[Dict[str, Any]]):
-        # Very small batches to respect embedding token limits
-        batch_size = 1
+        # Chroma amortizes its HNSW insert over each upsert call; embedding requests
+        # stay smaller to keep clear of the per-request token limit
+        batch_size = 512
+        embed_batch_size = 256
         for i in range(0, len(nodes), batch_size):
             batch = nodes[i:i + batch_size]
             ids: List[str] = []
@@ -34,7 +37,18 @@ class VectorStoreService:
                 documents.append(text_repr[:128])
                 ids.append(node_id)
                 metadatas.append({"label": label})
-            embeddings = self.embedding_service.embed_texts(documents)
+            # Skip nodes whose stored document is unchanged (their embedding would be too)
+            existing = self.collection.get(ids=ids, include=["documents"])
+            stored = dict(zip(existing.get("ids", []), existing.get("documents") or []))
+            changed = [j for j, (node_id, doc) in enumerate(zip(ids, documents)) if stored.get(node_id) != doc]
+            if not changed:
+                continue
+            ids = [ids[j] for j in changed]
+            documents = [documents[j] for j in changed]
+            metadatas = [metadatas[j] for j in changed]
+            embeddings: List[List[float]] = []
+            for j in range(0, len(documents), embed_batch_size):
+                embeddings.extend(self.embedding_service.embed_texts(documents[j:j + embed_batch_size]))
             self.collection.upsert(ids=ids, embeddings=embeddings, documents=documents, metadatas=metadatas)
 
     def similarity_search(self, query: str, top_k: int = 5) -> List[Dict[str, Any]]:
@@ -60,15 +74,12 @@ class VectorStoreService:
         if label:
             parts.append(f"Label: {label}")
         if properties:
-            count = 0
-            for k, v in properties.items():
+            for k, v in islice(properties.items(), 5):
                 # Truncate property values too
                 val_str = str(v)[:50] if v else ""
                 parts.append(f"{k}: {val_str}")
-                count += 1
-                if count >= 5:
-                    parts.append("...")
-                    break
+            if len(properties) >= 5:
+                parts.append("...")
         text = "\n".join(parts) if parts else "(empty)"
         return text
 